@@ -20,12 +20,17 @@ from discord.ext import commands
 import discord
 import logging
 import os
+import pss_designs as designs
 import pss_dropship as dropship
-import pss_fleets as flt
+import pss_fleet_history as fleet_history
 import pss_market as mkt
+import pss_market_store as market_store
 import pss_prestige as p
+import pss_prestige_graph as prestige_graph
+import pss_price_history as price_history
 import pss_research as rs
 import pytz
+import re
 import time, datetime, holidays
 
 
@@ -39,11 +44,15 @@ COOLDOWN = 30.0
 
 # tbl, rtbl = p.get_char_sheet()
 ctbl, tbl_i2n, tbl_n2i, rarity = p.get_char_sheet()
+prestige_graph.start_background_refresh(lambda: p.get_char_sheet()[1].keys())
 df_research_designs = rs.get_research_designs()
 
 raw_text = mkt.load_item_design_raw()
-df_items = mkt.xmltext_to_df(raw_text)
+df_items = designs.get_items(raw_text).to_df()
 item_rlookup = mkt.get_item_rlookup(df_items)
+price_history.update_history()
+mkt.start_market_poller()
+fleet_history.start_snapshotter()
 
 # welcome_txt = """**Welcome to the Pixel Starships Discord!**
 # This is a place where we can interact with devs and players from other alliances/fleets
@@ -123,13 +132,28 @@ async def prestige(ctx, *, name: str=None):
 
     # write_log(command_prefix + 'prestige {}'.format(name), ctx.author, ctx.server)
     # print("Calling p.prestige({}, 'from', tbl_i2n, tbl_n2i)".format(name))
-    prestige_txt, success = p.get_prestige(name, 'from', tbl_i2n, tbl_n2i)
+    prestige_txt, success = await p.get_prestige_async(name, 'from', tbl_i2n, tbl_n2i)
     # print("prestige_txt = {}".format(prestige_txt))
     # print("success = {}".format(success))
     for txt in prestige_txt:
         await ctx.send(txt)
 
 
+@bot.command(brief='Plan prestiges from crew you own')
+@commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
+async def plan(ctx, *, query=None):
+    """Find the shortest chains of prestiges that make the target crew from crew you own. Enter: plan [target] from [crew 1], [crew 2], ..."""
+    target, owned = (None, []) if query is None else p.parse_plan_query(query)
+    if target is None or len(owned) == 0:
+        help_txt = 'Enter: {}plan [target] from [crew 1], [crew 2], ...'.format(command_prefix)
+        await ctx.send(help_txt)
+        return
+
+    plan_txt, success = await p.get_prestige_plan_async(target, owned)
+    for txt in plan_txt:
+        await ctx.send(txt)
+
+
 @bot.command(brief='Get character/item recipes')
 @commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
 async def recipe(ctx, *, name=None):
@@ -143,7 +167,9 @@ async def recipe(ctx, *, name=None):
     recipe_found = False
 
     # Character Recipe
-    prestige_txt, success = p.get_prestige(name, 'to', tbl_i2n, tbl_n2i)
+    # (exact/partial names only: misspellings are matched against items)
+    prestige_txt, success = await p.get_prestige_async(
+        name, 'to', tbl_i2n, tbl_n2i, fuzzy=False)
     if success is True:
         for txt in prestige_txt:
             await ctx.send(txt)
@@ -151,7 +177,7 @@ async def recipe(ctx, *, name=None):
         return
 
     # Item Recipe
-    content, real_name = mkt.get_item_recipe(name, levels=5)
+    content, real_name = await mkt.get_item_recipe_async(name, levels=5)
     if real_name is not None:
         content = '**Recipe for {}**\n'.format(real_name) + content
         content = content + '\n\nNote: bux prices listed here may not always be accurate due to transfers between alts/friends or other reasons'
@@ -162,6 +188,37 @@ async def recipe(ctx, *, name=None):
         await ctx.send("Could not find character or item named '{}'".format(name))
 
 
+@bot.command(brief='Get the items crafted with an item')
+@commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
+async def uses(ctx, *, name=None):
+    """Get the items that can be crafted with an item, directly or through other recipes, with the quantity needed per craft"""
+    if name is None:
+        await ctx.send('Enter: {}uses [item name]'.format(command_prefix))
+        return
+
+    content, real_name = await mkt.get_item_uses_async(name)
+    if real_name is None:
+        await ctx.send("Could not find item named '{}'".format(name))
+        return
+    for txt in content:
+        await ctx.send(txt)
+
+
+@bot.command(brief='Get market listing prices of an item')
+@commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
+async def listings(ctx, *, item_name=None):
+    """Get the number of market listings of an item over the last 7 days, with the median and quartiles of their prices per item"""
+    if item_name is None:
+        await ctx.send('Enter: {}listings [item name]'.format(command_prefix))
+        return
+
+    txt, real_name = await market_store.get_price_history_async(item_name)
+    if txt is None:
+        await ctx.send("No market listings found for '{}'".format(item_name))
+    else:
+        await ctx.send(txt)
+
+
 # @bot.command(brief='Get recent market postings')
 # @commands.cooldown(rate=1, per=COOLDOWN, type=commands.BucketType.channel)
 # async def market(ctx):
@@ -179,14 +236,12 @@ async def price(ctx, *, item_name=None):
         return
 
     # write_log(command_prefix + '{} {}'.format(ctx.invoked_with, item_name), ctx.author, ctx.server)
-    raw_text = mkt.load_item_design_raw()
-    item_lookup = mkt.parse_item_designs(raw_text)
-
-    real_name = mkt.get_real_name(item_name, item_lookup)
     if len(item_name) < 2:
         await ctx.send("Please enter at least two characters for item name")
-    elif real_name is not None:
-        market_txt = mkt.filter_item_designs(item_name, item_lookup, filter='price')
+        return
+
+    market_txt, real_name = await mkt.get_item_price_async(item_name)
+    if real_name is not None:
         market_txt = "**Prices matching '{}'**\n".format(item_name) + market_txt
         market_txt += '\n\nNote: bux prices listed here may not always be accurate due to transfers between alts/friends or other reasons'
         await ctx.send(market_txt)
@@ -194,6 +249,32 @@ async def price(ctx, *, item_name=None):
         await ctx.send("Could not find item name '{}'".format(item_name))
 
 
+@bot.command(brief='Get the price trend of an item')
+@commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
+async def trend(ctx, *, item_name=None):
+    """Get the price of an item returned by the PSS API, and how it changed over the last 7 and 30 days"""
+    if item_name is None:
+        await ctx.send('Enter: {}trend [item name]'.format(command_prefix))
+        return
+
+    txt, real_name = await mkt.get_item_price_trend_async(item_name)
+    if txt is None:
+        await ctx.send("Could not find item name '{}'".format(item_name))
+    else:
+        await ctx.send(txt)
+
+
+@bot.command(brief='List the items whose price changed the most')
+@commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
+async def movers(ctx, days: int = 7):
+    """List the items whose price returned by the PSS API changed the most over the last days (7 by default)"""
+    txt = await mkt.get_top_movers_async(days)
+    if txt is None:
+        await ctx.send('Not enough price history for {} days'.format(days))
+    else:
+        await ctx.send(txt)
+
+
 @bot.command(name='list', brief='List items/characters')
 @commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
 async def list(ctx, *, action=''):
@@ -203,13 +284,13 @@ async def list(ctx, *, action=''):
     # write_log(command_prefix + ctx.invoked_with + ' ' + action, ctx.author, ctx.server)
     txt_list = []
     if action in ['chars', 'newchars']:
-        txt_list = p.get_char_list(action)
+        txt_list = await p.get_char_list_async(action)
     elif action == 'items':
-        txt_list = mkt.get_item_list()
+        txt_list = await mkt.get_item_list_async()
     elif action == 'research':
-        txt_list = rs.get_research_names()
+        txt_list = await rs.get_research_names_async()
     elif action == 'rooms':
-        txt_list = rs.get_room_names()
+        txt_list = await rs.get_room_names_async()
 
     for txt in txt_list:
         await ctx.send(txt)
@@ -228,7 +309,7 @@ async def stats(ctx, *, name=None):
     # (skip this section if command was invoked with 'item'
     if ctx.invoked_with != 'item':
         # write_log('stats {}'.format(name), str(ctx.author), str(ctx.server))
-        result = p.get_stats(name, embed=False)
+        result = await p.get_stats_async(name, embed=False)
         if result is not None:
             await ctx.send(result)
             found_match = True
@@ -237,7 +318,7 @@ async def stats(ctx, *, name=None):
     # raw_text = mkt.load_item_design_raw()
     # item_lookup = mkt.parse_item_designs(raw_text)
     # market_txt = mkt.filter_item_designs(name, item_lookup, filter='stats')
-    market_txt = mkt.get_item_stats(name)
+    market_txt = await mkt.get_item_stats_async(name)
     if market_txt is not None:
         await ctx.send(market_txt)
         found_match = True
@@ -259,31 +340,37 @@ async def stats(ctx, *, name=None):
 #         #     await bot.send_message(ctx.message.channel, embed=result)
 
 
+@bot.command(brief='List the most profitable crafts')
+@commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
+async def crafts(ctx, n: int = 10):
+    """List the items that sell for the most bux above the market price of the raw materials needed to craft them"""
+    txt_list = await mkt.get_profitable_crafts_async(min(max(n, 1), 25))
+    if txt_list is None:
+        await ctx.send('No craftable items have prices')
+    else:
+        for txt in txt_list:
+            await ctx.send(txt)
+
+
 @bot.command(brief='Get best items for a slot')
 @commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
-async def best(ctx, slot=None, enhancement=None):
-    """Get the best enhancement item for a given slot. If multiple matches are found, matches will be shown in descending order."""
+async def best(ctx, slot=None, enhancement=None, max_price: int = None, rarity=None):
+    """Get the best enhancement item for a given slot. If multiple matches are found, matches will be shown in descending order. Optionally only show items up to a price in bux, and of a rarity."""
     if slot is None:
-        txt = 'Enter: {}best [slot] [enhancement]'.format(command_prefix)
+        txt = 'Enter: {}best [slot] [enhancement] [max price] [rarity]'.format(command_prefix)
         await ctx.send(txt)
         return
     txt = command_prefix + 'best {} {}'.format(slot, enhancement)
     # write_log(txt, ctx.author, ctx.server)
 
-    raw_text = mkt.load_item_design_raw()
-    item_lookup = mkt.parse_item_designs(raw_text)
-    df_items = mkt.rtbl2items(item_lookup)
-    df_filter = mkt.filter_item(
-        df_items, slot, enhancement,
-        cols=['ItemDesignName', 'EnhancementValue', 'MarketPrice'])
-
-    txt = mkt.itemfilter2txt(df_filter)
+    txt, index = await mkt.get_best_items_async(
+        slot, enhancement, max_price=max_price, rarity=rarity)
     if txt is None:
         await ctx.send('No entries found for {} slot, {} enhancement'.format(
             slot, enhancement))
 
-        str_slots = ', '.join(df_items['ItemSubType'].value_counts().index)
-        str_enhancements = ', '.join(df_items['EnhancementType'].value_counts().index)
+        str_slots = ', '.join(index.slots)
+        str_enhancements = ', '.join(index.enhancements)
         txt  = 'Slots: {}\n'.format(str_slots)
         txt += 'Enhancements: {}'.format(str_enhancements)
         await ctx.send(txt)
@@ -291,6 +378,24 @@ async def best(ctx, slot=None, enhancement=None):
         await ctx.send(txt)
 
 
+@bot.command(brief='Get the best gear within a budget')
+@commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
+async def loadout(ctx, budget: int = None, enhancements=None, *, character=None):
+    """Get the items that give the most of the enhancements for a total price in bux. Enhancements can be weighted, e.g. attack,hp=0.5. If a character is given, only the slots they can equip are filled."""
+    if budget is None or enhancements is None:
+        txt = 'Enter: {}loadout [budget] [enhancement,enhancement=weight] [character]'.format(command_prefix)
+        await ctx.send(txt)
+        return
+
+    try:
+        weights = mkt.parse_weights(enhancements)
+    except ValueError:
+        await ctx.send("Could not read the enhancements '{}'".format(enhancements))
+        return
+    txt, success = await mkt.get_loadout_async(weights, budget, character)
+    await ctx.send(txt)
+
+
 @bot.command(brief='Get research data')
 @commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
 async def research(ctx, *, research=None):
@@ -303,13 +408,35 @@ async def research(ctx, *, research=None):
     # write_log(txt, ctx.author, ctx.server)
 
     df_selected = rs.filter_researchdf(df_research_designs, research)
-    txt = rs.research_to_txt(df_selected)
+    research_tree = await rs.get_research_tree_async()
+    txt = rs.research_to_txt(df_selected, research_tree)
     if txt is None:
         await ctx.send("No entries found for '{}'".format(research))
     else:
         await ctx.send(txt)
 
 
+@bot.command(brief='Get room data')
+@commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
+async def room(ctx, *, room=None):
+    """Get the details on a specific room, with the total cost and time of building it from the first level. Enter two rooms separated by 'to' to get the cost of upgrading from one to the other, e.g. Hangar Lv2 to Hangar Lv5"""
+    if room is None:
+        txt = 'Enter: {}room [room] or {}room [room] to [room]'.format(
+            command_prefix, command_prefix)
+        await ctx.send(txt)
+        return
+
+    rooms = re.split(r'\s+to\s+', room, maxsplit=1, flags=re.IGNORECASE)
+    if len(rooms) == 2:
+        txt = await rs.get_room_upgrade_txt_async(*rooms)
+    else:
+        txt = await rs.get_room_txt_async(room)
+    if txt is None:
+        await ctx.send("No entries found for '{}'".format(room))
+    else:
+        await ctx.send(txt)
+
+
 @bot.command(brief='Get collections')
 @commands.cooldown(rate=RATE, per=COOLDOWN, type=commands.BucketType.channel)
 async def collection(ctx, *, collection=None):
@@ -322,7 +449,7 @@ async def collection(ctx, *, collection=None):
     # write_log(txt, ctx.author, ctx.server)
 
     print(collection)
-    txt = p.show_collection(collection)
+    txt = await p.show_collection_async(collection)
     if txt is None:
         await ctx.send("No entries found for '{}'".format(collection))
     else:
@@ -339,8 +466,9 @@ async def stars(ctx, *, division=None):
         return
     txt = command_prefix + 'stars {}'.format(division)
     # write_log(txt, ctx.author, ctx.server)
-    txt = flt.get_division_stars(division)
-    await ctx.send(txt)
+    txt_list = await fleet_history.get_division_stars_async(division)
+    for txt in txt_list:
+        await ctx.send(txt)
 
 
 # @commands.cooldown(rate=1, per=COOLDOWN, type=commands.BucketType.channel)
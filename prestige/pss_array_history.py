@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Pixel Starships Array History
+#
+# Values recorded over time as typed [time, id] arrays, stored in npz
+# files. Shared by the item price and the fleet histories
+
+
+# ----- Packages ------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+import numpy as np
+import os
+import threading
+
+import pss_core as core
+
+
+# ----- History -------------------------------------------------------
+class ArrayHistory(object):
+    """[time, id] int32 arrays, one per column of COLUMNS, with the times
+    (sorted) and the ids (sorted) along the axes. Values that are not
+    known hold MISSING. Subclasses set COLUMNS, the dtypes of the axes
+    and the names the axes are stored under"""
+
+    COLUMNS = ()
+    MISSING = -1
+    TIME_DTYPE = float
+    ID_DTYPE = np.int64
+    TIME_KEY = 'times'
+    ID_KEY = 'ids'
+
+    def __init__(self, times=None, ids=None, values=None):
+        self.lock = threading.RLock()
+        self.times = np.array([], dtype=self.TIME_DTYPE) if times is None else times
+        self.ids = np.array([], dtype=self.ID_DTYPE) if ids is None else ids
+        if values is None:
+            values = {column: np.zeros((0, 0), dtype=np.int32)
+                      for column in self.COLUMNS}
+        self.values = values
+
+    def _add_ids(self, ids):
+        """Adds a column of MISSING for each id that is new. Returns the
+        positions the old ids moved to, or None if no id is new"""
+        new_ids = np.setdiff1d(ids, self.ids)
+        if len(new_ids) == 0:
+            return None
+        all_ids = np.union1d(self.ids, new_ids).astype(self.ID_DTYPE)
+        old_columns = np.searchsorted(all_ids, self.ids)
+        for column in self.COLUMNS:
+            grown = np.full((len(self.times), len(all_ids)), self.MISSING, dtype=np.int32)
+            grown[:, old_columns] = self.values[column]
+            self.values[column] = grown
+        self.ids = all_ids
+        return old_columns
+
+    def _add_time(self, time, replace=False):
+        """Index of a new row of MISSING for time. With replace, the row
+        of time is reused if there is one"""
+        i = np.searchsorted(self.times, time)
+        if replace and i < len(self.times) and self.times[i] == time:
+            return i
+        self.times = np.insert(self.times, i, time)
+        for column in self.COLUMNS:
+            self.values[column] = np.insert(
+                self.values[column], i, self.MISSING, axis=0)
+        return i
+
+    def _set_row(self, i, ids, values):
+        """Sets row i to values ({column: values of ids}), MISSING for
+        the other ids"""
+        columns = np.searchsorted(self.ids, ids)
+        for column in self.COLUMNS:
+            row = np.full(len(self.ids), self.MISSING, dtype=np.int32)
+            row[columns] = values[column]
+            self.values[column][i] = row
+
+    def add(self, time, ids, values, replace=False):
+        """Records values ({column: values of ids}) at time"""
+        ids = np.asarray(ids, dtype=self.ID_DTYPE)
+        with self.lock:
+            self._add_ids(ids)
+            i = self._add_time(time, replace)
+            self._set_row(i, ids, values)
+
+    def get_row(self, time):
+        """Index of the last row at or before time (None if before the
+        first one)"""
+        i = np.searchsorted(self.times, time, side='right') - 1
+        return None if i < 0 else i
+
+    def to_arrays(self):
+        arrays = {self.TIME_KEY: self.times, self.ID_KEY: self.ids}
+        arrays.update(self.values)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, data):
+        values = {column: data[column] for column in cls.COLUMNS}
+        return cls(data[cls.TIME_KEY], data[cls.ID_KEY], values)
+
+
+# ----- Storage -------------------------------------------------------
+def save_history(history, filename):
+    with history.lock, core.open_atomic(filename, 'wb') as f:
+        np.savez(f, **history.to_arrays())
+
+
+def load_history(history_type, filename):
+    if not os.path.isfile(filename):
+        return history_type()
+    with np.load(filename, allow_pickle=False) as data:
+        return history_type.from_arrays(data)
+
+
+_histories = {}
+_histories_lock = threading.Lock()
+
+
+def get_history(history_type, filename):
+    """The history stored in filename, loaded once and shared"""
+    with _histories_lock:
+        history = _histories.get(filename)
+        if history is None:
+            history = _histories[filename] = load_history(history_type, filename)
+        return history
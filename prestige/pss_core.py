@@ -1,23 +1,286 @@
+from collections import Counter, namedtuple, OrderedDict
+import asyncio
+import concurrent.futures
+import contextlib
 import csv
 import datetime
+import functools
+import gzip
+import heapq
+import http.client
+import itertools
+import json
 import os
+import pandas as pd
 import re
-import urllib.request
+import threading
+import time
+import urllib.error
+import urllib.parse
 import xml.etree.ElementTree
+import zlib
+
+
+# ----- HTTP Client ------------------------------
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_READ_TIMEOUT = 30.0
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_POOL_SIZE = 8
+HTTP_RETRY_STATUS = (429, 500, 502, 503, 504)
+HTTP_REDIRECT_STATUS = (301, 302, 303, 307, 308)
+HTTP_MAX_REDIRECTS = 5
+# Seconds a pooled connection may sit idle before it is closed instead of
+# reused, below the common 5 s keep-alive timeout of servers
+HTTP_POOL_MAX_IDLE = 4.0
+
+# headers is the http.client.HTTPMessage, so lookups ignore case
+HttpResponse = namedtuple('HttpResponse', ['status', 'headers', 'body'])
+
+
+class HttpClient(object):
+    """Keep-alive HTTP client with one connection pool per host.
+    Responses may be gzip/deflate compressed, failed requests are
+    retried with exponential backoff"""
+
+    def __init__(self, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, retries=HTTP_RETRIES,
+                 backoff=HTTP_BACKOFF, pool_size=HTTP_POOL_SIZE,
+                 max_idle=HTTP_POOL_MAX_IDLE):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, scheme, host, fresh=False):
+        """Returns (connection, reused): the most recently released pooled
+        connection that has not been idle for too long, or a new one"""
+        stale = []
+        conn = None
+        if not fresh:
+            now = time.monotonic()
+            with self._lock:
+                pool = self._pools.get((scheme, host), [])
+                while pool:
+                    conn, released = pool.pop()
+                    if now - released <= self.max_idle:
+                        break
+                    stale.append(conn)
+                    conn = None
+        for old_conn in stale:
+            old_conn.close()
+        if conn is not None:
+            return conn, True
+
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, timeout=self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(host, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn, False
+
+    def _release(self, scheme, host, conn):
+        with self._lock:
+            pool = self._pools.setdefault((scheme, host), [])
+            if len(pool) < self.pool_size:
+                pool.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def _drop_pool(self, scheme, host):
+        with self._lock:
+            pool = self._pools.pop((scheme, host), [])
+        for conn, _ in pool:
+            conn.close()
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for conn, _ in pool:
+                conn.close()
+
+    def _request_once(self, scheme, host, path, headers):
+        conn, reused = self._acquire(scheme, host)
+        while True:
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                break
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+            # The server closed the pooled connection while it was idle,
+            # so it probably closed the other idle ones too: retry at once
+            # on a new connection, this is not a failed attempt
+            self._drop_pool(scheme, host)
+            conn, reused = self._acquire(scheme, host, fresh=True)
+
+        try:
+            body = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(scheme, host, conn)
+
+        encoding = resp.getheader('Content-Encoding', '').lower()
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        return HttpResponse(resp.status, resp.msg, body)
+
+    def request(self, url, headers=None):
+        """GET the url and return an HttpResponse. Redirects are followed
+        (up to HTTP_MAX_REDIRECTS), connection errors and HTTP_RETRY_STATUS
+        responses are retried. Any other status >= 300 but 304 raises
+        urllib.error.HTTPError"""
+        for _ in range(HTTP_MAX_REDIRECTS + 1):
+            resp = self._request_retrying(url, headers)
+            location = resp.headers.get('Location')
+            if resp.status not in HTTP_REDIRECT_STATUS or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+
+        if resp.status >= 300 and resp.status != 304:
+            raise urllib.error.HTTPError(
+                url, resp.status, http.client.responses.get(resp.status, ''),
+                resp.headers, None)
+        return resp
+
+    def _request_retrying(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        req_headers = {'Accept-Encoding': 'gzip, deflate',
+                       'Connection': 'keep-alive'}
+        if headers is not None:
+            req_headers.update(headers)
+
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                resp = self._request_once(
+                    parts.scheme, parts.netloc, path, req_headers)
+            except (OSError, http.client.HTTPException):
+                if last_attempt:
+                    raise
+            else:
+                if resp.status not in HTTP_RETRY_STATUS or last_attempt:
+                    break
+            time.sleep(self.backoff * 2**attempt)
+        return resp
+
+    def get(self, url):
+        return self.request(url).body.decode('utf-8')
+
+
+http_client = HttpClient()
+
+
+# ----- Rate Limits ------------------------------
+# Requests per second per host for the crawlers and pollers
+HOST_RATE_LIMIT = 5.0
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+class RateLimiter(object):
+    """Spaces out calls to wait() so that they happen at most `rate`
+    times per second, across all threads"""
+
+    def __init__(self, rate=None):
+        if rate is None:
+            rate = HOST_RATE_LIMIT
+        self.interval = 1.0 / rate
+        self._next_time = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_rate_limiter(url):
+    host = urllib.parse.urlsplit(url).netloc
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(host)
+        if limiter is None:
+            limiter = _rate_limiters[host] = RateLimiter()
+        return limiter
+
+
+def get_data_from_url_limited(url):
+    """get_data_from_url, within the per-host rate limit"""
+    get_rate_limiter(url).wait()
+    return get_data_from_url(url)
+
+
+# ----- Async ------------------------------------
+# Blocking fetches and parsing run on this pool so that
+# the bot's event loop is never blocked
+ASYNC_WORKERS = 8
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_WORKERS)
+
+
+async def run_in_executor(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs))
+
+
+async def get_data_from_url_async(url):
+    return await run_in_executor(get_data_from_url, url)
+
+
+async def load_data_from_url_async(filename, url, refresh='auto'):
+    return await run_in_executor(load_data_from_url, filename, url, refresh)
 
 
 # ----- Utilities --------------------------------
 def get_data_from_url(url):
-    data = urllib.request.urlopen(url).read()
-    return data.decode('utf-8')
+    return http_client.get(url)
 
-def save_raw_text(raw_text, filename):
+@contextlib.contextmanager
+def open_atomic(filename, mode='w', **kwargs):
+    """Opens a temporary file (one per thread) that replaces filename
+    once it is written, so readers never see a partial file"""
+    tmp_filename = '{}.{}.tmp'.format(filename, threading.get_ident())
     try:
-        with open(filename, 'w') as f:
-            f.write(raw_text)
-    except:
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(raw_text)
+        with open(tmp_filename, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def save_raw_text(raw_text, filename):
+    with open_atomic(filename, 'w', encoding='utf-8') as f:
+        f.write(raw_text)
+
+
+def load_raw_text(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return f.read()
 
 
 def is_old_file(filename, max_days=0, max_seconds=3600, verbose=True):
@@ -31,46 +294,264 @@ def is_old_file(filename, max_days=0, max_seconds=3600, verbose=True):
     time_diff = now - datetime.datetime.fromtimestamp(mtime)
     if verbose is True:
         print('Time since file {} creation: {}'.format(filename, time_diff))
-    return (time_diff.days > max_days) or time_diff.seconds > max_seconds
-
-
-def load_data_from_url(filename, url, refresh='auto'):
-    if os.path.isfile(filename) and refresh != 'true':
-        if refresh == 'auto':
-            if is_old_file(filename, max_seconds=3600):
-                raw_text = get_data_from_url(url)
-                save_raw_text(raw_text, filename)
-                return raw_text
-        with open(filename, 'r') as f:
-            raw_text = f.read()
+    return time_diff.total_seconds() > max_days*24*3600 + max_seconds
+
+
+# ----- Cache ------------------------------------
+# Seconds before a cached download is considered stale, by endpoint
+CACHE_DEFAULT_TTL = 3600
+CACHE_TTLS = {
+    'AllianceService/ListAlliancesByRanking': 60,
+    'CharacterService/ListAllCharacterDesigns': 24*3600,
+    'CollectionService/ListAllCollectionDesigns': 24*3600,
+    'ItemService/ListItemDesigns2': 3600,
+    'ResearchService/ListAllResearchDesigns2': 24*3600,
+    'RoomService/ListRoomDesigns2': 24*3600,
+    'SettingService/GetLatestVersion': 3600}
+
+# Stale files younger than ttl + CACHE_STALE_WINDOW are served as is
+# while they are revalidated in the background
+CACHE_STALE_WINDOW = 24*3600
+
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+
+
+def get_cache_ttl(url):
+    path = urllib.parse.urlsplit(url).path
+    for endpoint, ttl in CACHE_TTLS.items():
+        if path.endswith(endpoint):
+            return ttl
+    return CACHE_DEFAULT_TTL
+
+
+def load_cache_meta(filename):
+    """Returns the metadata stored next to a cached download: the time it
+    was last fetched or revalidated and the ETag/Last-Modified validators"""
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename + '.meta', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'fetched': os.stat(filename).st_mtime}
+
+
+def save_cache_meta(filename, meta):
+    save_raw_text(json.dumps(meta), filename + '.meta')
+
+
+def revalidate_cache(filename, url):
+    """Downloads the url, sending the stored validators so that an
+    unchanged resource costs a 304 instead of a full download"""
+    meta = load_cache_meta(filename)
+    headers = {}
+    if meta is not None and os.path.isfile(filename):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    resp = http_client.request(url, headers=headers)
+    if resp.status == 304:
+        raw_text = load_raw_text(filename)
     else:
-        raw_text = get_data_from_url(url)
+        raw_text = resp.body.decode('utf-8')
         save_raw_text(raw_text, filename)
+        meta = {'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified')}
+    meta['fetched'] = time.time()
+    save_cache_meta(filename, meta)
     return raw_text
 
 
+def _revalidate_in_background(filename, url):
+    with _revalidating_lock:
+        if filename in _revalidating:
+            return
+        _revalidating.add(filename)
+
+    def revalidate():
+        try:
+            revalidate_cache(filename, url)
+        except Exception as e:
+            print('Background refresh of {} failed: {}'.format(filename, e))
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard(filename)
+
+    executor.submit(revalidate)
+
+
+def load_data_from_url(filename, url, refresh='auto', ttl=None):
+    """Returns the text at url, cached in filename.
+    refresh='auto': use the cache while it is younger than ttl (default:
+                    per endpoint, see CACHE_TTLS), serve it stale while
+                    revalidating in the background, or revalidate first
+                    once it is too old
+    refresh='true': always revalidate with the server
+    otherwise:      use the cache whenever it exists"""
+    meta = load_cache_meta(filename)
+    if meta is None or refresh in ('true', True):
+        return revalidate_cache(filename, url)
+    if refresh != 'auto':
+        return load_raw_text(filename)
+
+    if ttl is None:
+        ttl = get_cache_ttl(url)
+    age = time.time() - meta.get('fetched', 0)
+    if age <= ttl:
+        return load_raw_text(filename)
+    if age <= ttl + CACHE_STALE_WINDOW:
+        _revalidate_in_background(filename, url)
+        return load_raw_text(filename)
+    return revalidate_cache(filename, url)
+
+
+# ----- Memory Cache -----------------------------
+class SingleFlightCache(object):
+    """In-process cache of computed values, each kept for ttl seconds.
+    Callers asking for a key that is missing or expired while it is
+    being computed wait for that computation instead of starting their
+    own"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.values = {}
+        self.in_flight = {}
+
+    def get(self, key, compute):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            future = self.in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = concurrent.futures.Future()
+                self.in_flight[key] = future
+        if not is_leader:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            now = time.monotonic()
+            # Drop the expired entries so that old keys do not pile up
+            self.values = {k: v for k, v in self.values.items()
+                           if now - v[0] < self.ttl}
+            self.values[key] = (now, value)
+            del self.in_flight[key]
+        future.set_result(value)
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = (time.monotonic(), value)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+# ----- XML Parsing ------------------------------
+XML_CHUNK_SIZE = 64*1024
+
+
+def _iter_xml_chunks(source):
+    if isinstance(source, (str, bytes)):
+        for i in range(0, len(source), XML_CHUNK_SIZE):
+            yield source[i:i+XML_CHUNK_SIZE]
+    else:
+        while True:
+            chunk = source.read(XML_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_xml_records(source, tag=None, depth=3):
+    """Yields the attributes of the record elements `depth` levels below
+    the document root (optionally only those named `tag`) as the document
+    is parsed. Records are dropped from the tree once read, so memory use
+    stays flat however long the list is. source is the XML text or a
+    readable file-like object. Only the parsing is streamed: the HTTP
+    client and the download cache read the whole body first, so parsing
+    does not overlap with the download"""
+    parser = xml.etree.ElementTree.XMLPullParser(events=('start', 'end'))
+    stack = []
+
+    def read_records():
+        for event, elem in parser.read_events():
+            if event == 'start':
+                stack.append(elem)
+                continue
+            stack.pop()
+            if len(stack) != depth:
+                continue
+            if tag is None or elem.tag == tag:
+                yield dict(elem.attrib)
+            elem.clear()
+            stack[-1].remove(elem)
+
+    for chunk in _iter_xml_chunks(source):
+        parser.feed(chunk)
+        yield from read_records()
+    parser.close()
+    yield from read_records()
+
+
+def xml_records_to_df(raw_text, tag=None, depth=3, dtypes=None):
+    """Builds a DataFrame from the XML records in one pass: attributes
+    are collected into one list per column and the frame is created once.
+    dtypes maps column names to the type they are converted to; missing
+    or blank numbers become 0"""
+    columns = {}
+    n_rows = 0
+    for record in iter_xml_records(raw_text, tag=tag, depth=depth):
+        for key, value in record.items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [None] * n_rows
+            column.append(value)
+        n_rows += 1
+        if len(record) != len(columns):
+            for column in columns.values():
+                if len(column) < n_rows:
+                    column.append(None)
+
+    df = pd.DataFrame(columns)
+    if dtypes is not None:
+        for col, dtype in dtypes.items():
+            if col in df.columns:
+                df[col] = pd.to_numeric(
+                    df[col], errors='coerce').fillna(0).astype(dtype)
+    return df
+
+
 def xmltree_to_dict3(raw_text, key):
-    root = xml.etree.ElementTree.fromstring(raw_text)
-    for c in root:
-        for cc in c:
-            d = {}
-            for ccc in cc:
-                d[ccc.attrib[key]] = ccc.attrib
+    d = {}
+    for record in iter_xml_records(raw_text, depth=3):
+        d[record[key]] = record
     return d
 
 
 def xmltree_to_dict2(raw_text, key=None):
-    root = xml.etree.ElementTree.fromstring(raw_text)
-    for c in root:
-        d = {}
-        for cc in c:
-            if key is None:
-                d = cc.attrib
-            else:
-                d[cc.attrib[key]] = cc.attrib
+    d = {}
+    for record in iter_xml_records(raw_text, depth=2):
+        if key is None:
+            d = record
+        else:
+            d[record[key]] = record
     return d
 
-    
+
 def create_reverse_lookup(d, new_key, new_value):
     rlookup = {}
     for key in d.keys():
@@ -80,19 +561,19 @@ def create_reverse_lookup(d, new_key, new_value):
 
 
 # ----- Display -----
-def list_to_text(lst, max_chars=1900):
+def list_to_text(lst, max_chars=1900, sep=', '):
     txt_list = []
     txt = ''
     for i, item in enumerate(lst):
         if i == 0:
             txt = item
         else:
-            new_text = txt + ', ' + item
+            new_text = txt + sep + item
             if len(new_text) > max_chars:
                 txt_list += [txt]
                 txt = item
             else:
-                txt += ', ' + item
+                txt += sep + item
     txt_list += [txt]
     return txt_list
 
@@ -104,26 +585,173 @@ def fix_search_text(search_text):
     return new_txt
 
 
+NAME_INDEX_GRAM = 3
+NAME_INDEX_CACHE_SIZE = 16
+
+# Fuzzy matching compares the padded n-grams of the names (Dice
+# similarity, 0...1). Bigrams tolerate swapped letters in short
+# names better than trigrams do
+FUZZY_GRAM = 2
+FUZZY_MIN_SCORE = 0.4
+
+_name_indexes = OrderedDict()
+_name_indexes_lock = threading.Lock()
+
+
+class NameIndex(object):
+    """Search index over a list of names. Names are normalized once with
+    `normalize` (which also applies aliases, e.g. fix_char/fix_item).
+    Exact lookups are a dict access; substring lookups only check the
+    names that contain every n-gram of the query. Queries are plain text,
+    not regular expressions"""
+
+    def __init__(self, names, normalize=fix_search_text):
+        self.names = list(names)
+        self.normalize = normalize
+        self.keys = [normalize(name) for name in self.names]
+        self.exact = {}
+        self.grams = {}
+        self.fuzzy_grams = {}
+        self.fuzzy_gram_counts = []
+        for i, key in enumerate(self.keys):
+            self.exact.setdefault(key, i)
+            for gram in self._get_grams(key):
+                self.grams.setdefault(gram, []).append(i)
+            fuzzy_grams = self._get_fuzzy_grams(key)
+            self.fuzzy_gram_counts.append(len(fuzzy_grams))
+            for gram in fuzzy_grams:
+                self.fuzzy_grams.setdefault(gram, []).append(i)
+
+    @staticmethod
+    def _get_grams(key):
+        grams = set()
+        for n in range(1, NAME_INDEX_GRAM + 1):
+            for i in range(len(key) - n + 1):
+                grams.add(key[i:i+n])
+        return grams
+
+    @staticmethod
+    def _get_fuzzy_grams(key):
+        # Padding lets the first/last characters count in short names
+        padded = ' '*(FUZZY_GRAM - 1) + key + ' '
+        return set(padded[i:i+FUZZY_GRAM]
+                   for i in range(len(padded) - FUZZY_GRAM + 1))
+
+    def find(self, query):
+        """Returns the name whose normalized form is the query, or None"""
+        idx = self.exact.get(self.normalize(query))
+        return None if idx is None else self.names[idx]
+
+    def search(self, query):
+        """Returns the names containing the normalized query, in order.
+        A query with nothing left after normalizing matches no name"""
+        key = self.normalize(query)
+        if len(key) == 0:
+            return []
+        n = min(len(key), NAME_INDEX_GRAM)
+        query_grams = set(key[i:i+n] for i in range(len(key) - n + 1))
+        postings = sorted(
+            (self.grams.get(gram, []) for gram in query_grams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if len(candidates) == 0:
+                return []
+        return [self.names[i] for i in sorted(candidates)
+                if key in self.keys[i]]
+
+    def fuzzy(self, query, k=5, min_score=FUZZY_MIN_SCORE):
+        """Returns up to k (name, score) pairs ranked by n-gram
+        similarity to the query, so misspelled names are still found"""
+        query_grams = self._get_fuzzy_grams(self.normalize(query))
+        shared = Counter(itertools.chain.from_iterable(
+            self.fuzzy_grams.get(gram, ()) for gram in query_grams))
+        n_query = len(query_grams)
+        scores = ((2.0 * n / (n_query + self.fuzzy_gram_counts[i]), i)
+                  for i, n in shared.items())
+        best = heapq.nlargest(k, scores, key=lambda score: (score[0], -score[1]))
+        return [(self.names[i], score) for score, i in best
+                if score >= min_score]
+
+
+def get_name_index(names, normalize=fix_search_text, source=None):
+    """Returns the NameIndex over names (a list of names or a dict keyed
+    by them). Indexes are cached by the identity of source (by default
+    names itself), so callers pass an object that is replaced, not
+    changed, when the names change, e.g. the by_name dict of a
+    DesignIndex. A lookup does not copy or hash the names"""
+    if source is None:
+        source = names
+    cache_key = (normalize, id(source))
+    with _name_indexes_lock:
+        entry = _name_indexes.get(cache_key)
+        # The entry holds on to source, so its id cannot be reused
+        if entry is not None and entry[0] is source:
+            _name_indexes.move_to_end(cache_key)
+            return entry[1]
+    index = NameIndex(names, normalize)
+    with _name_indexes_lock:
+        _name_indexes[cache_key] = (source, index)
+        while len(_name_indexes) > NAME_INDEX_CACHE_SIZE:
+            _name_indexes.popitem(last=False)
+    return index
+
+
+def get_fuzzy_name(search_str, lst_original, normalize=fix_search_text):
+    """Returns the closest name to a (possibly misspelled) search string,
+    or None if nothing scores at least FUZZY_MIN_SCORE"""
+    matches = get_name_index(lst_original, normalize).fuzzy(search_str, k=1)
+    if len(matches) > 0:
+        return matches[0][0]
+    return None
+
+
 def get_real_name(search_str, lst_original):
-    lst_lookup = [ fix_search_text(s) for s in lst_original ]
-    txt_fixed = fix_search_text(search_str)
-    try:
-        idx = lst_lookup.index(txt_fixed)
-        return lst_original[idx]
-    except:
-        m = [re.search(txt_fixed, t) is not None for t in lst_lookup]
-        if sum(m) > 0:
-            return [txt for (txt, found) in zip(lst_original, m) if found][0]
-        else:
-            return None
+    index = get_name_index(lst_original)
+    real_name = index.find(search_str)
+    if real_name is not None:
+        return real_name
+    matches = index.search(search_str)
+    if len(matches) > 0:
+        return matches[0]
+    else:
+        return None
 
 
 # ----- Get Production Server -----
-def get_production_server():
-    url = 'http://api.pixelstarships.com/SettingService/GetLatestVersion?languageKey=en'
-    raw_text = get_data_from_url(url)
-    d = xmltree_to_dict2(raw_text, key=None)
-    return d['ProductionServer']
+# Set PSS_PRODUCTION_SERVER (e.g. api2.pixelstarships.com) to skip discovery
+PRODUCTION_SERVER = os.getenv('PSS_PRODUCTION_SERVER')
+PRODUCTION_SERVER_FILE = 'pss-latest-version-raw.txt'
+PRODUCTION_SERVER_URL = 'http://api.pixelstarships.com/SettingService/GetLatestVersion?languageKey=en'
+
+_production_server = None
+_production_server_time = 0
+_production_server_lock = threading.Lock()
+
+
+def get_production_server(refresh=False):
+    """Discovers the production server on first use. The answer is kept
+    in memory and on disk (PRODUCTION_SERVER_FILE) for the
+    GetLatestVersion TTL, see CACHE_TTLS"""
+    global _production_server, _production_server_time
+    if PRODUCTION_SERVER:
+        return PRODUCTION_SERVER
+
+    ttl = get_cache_ttl(PRODUCTION_SERVER_URL)
+    with _production_server_lock:
+        age = time.time() - _production_server_time
+        if _production_server is None or age > ttl or refresh is True:
+            raw_text = load_data_from_url(
+                PRODUCTION_SERVER_FILE, PRODUCTION_SERVER_URL,
+                refresh='true' if refresh is True else 'auto')
+            d = xmltree_to_dict2(raw_text, key=None)
+            _production_server = d['ProductionServer']
+            _production_server_time = time.time()
+        return _production_server
+
+
+def get_api_base_url():
+    return 'http://{}/'.format(get_production_server())
 
 
 # ----- Character Sheets -----
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Pixel Starships Design Registry
+
+
+# ----- Packages ------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+import hashlib
+import pandas as pd
+import pickle
+import struct
+import threading
+
+import pss_core as core
+
+
+# ----- Field Types ---------------------------------------------------
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def to_number(value):
+    # Stats are sent as e.g. '12' or '1.5', keep integers as int
+    # so that they display the way the API sent them
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return int(value) if value.is_integer() else value
+
+
+def to_str(value):
+    return '' if value is None else value
+
+
+# ----- Design Records ------------------------------------------------
+class Design(object):
+    """Base class of the design records. FIELDS lists (slot, XML attribute,
+    parser) for each field, so numbers are parsed once when the record is
+    created"""
+    __slots__ = ()
+    FIELDS = ()
+    TAG = None
+
+    @classmethod
+    def from_record(cls, record):
+        design = cls.__new__(cls)
+        for slot, attrib, parse in cls.FIELDS:
+            setattr(design, slot, parse(record.get(attrib)))
+        return design
+
+    def to_record(self):
+        return {attrib: getattr(self, slot)
+                for slot, attrib, _ in self.FIELDS}
+
+    def __repr__(self):
+        return '{}(id={}, name={!r})'.format(
+            type(self).__name__, self.id, self.name)
+
+
+class CharacterDesign(Design):
+    TAG = 'CharacterDesign'
+    FIELDS = (
+        ('id', 'CharacterDesignId', to_int),
+        ('name', 'CharacterDesignName', to_str),
+        ('description', 'CharacterDesignDescription', to_str),
+        ('rarity', 'Rarity', to_str),
+        ('race_type', 'RaceType', to_str),
+        ('gender_type', 'GenderType', to_str),
+        ('collection_id', 'CollectionDesignId', to_int),
+        ('equipment_mask', 'EquipmentMask', to_int),
+        ('special_ability_type', 'SpecialAbilityType', to_str),
+        ('special_ability_argument', 'SpecialAbilityFinalArgument', to_number),
+        ('hp', 'FinalHp', to_number),
+        ('attack', 'FinalAttack', to_number),
+        ('repair', 'FinalRepair', to_number),
+        ('pilot', 'FinalPilot', to_number),
+        ('science', 'FinalScience', to_number),
+        ('weapon', 'FinalWeapon', to_number),
+        ('engine', 'FinalEngine', to_number),
+        ('walking_speed', 'WalkingSpeed', to_number),
+        ('run_speed', 'RunSpeed', to_number),
+        ('fire_resistance', 'FireResistance', to_number),
+        ('training_capacity', 'TrainingCapacity', to_number))
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class ItemDesign(Design):
+    TAG = 'ItemDesign'
+    FIELDS = (
+        ('id', 'ItemDesignId', to_int),
+        ('name', 'ItemDesignName', to_str),
+        ('item_type', 'ItemType', to_str),
+        ('item_sub_type', 'ItemSubType', to_str),
+        ('rarity', 'Rarity', to_str),
+        ('enhancement_type', 'EnhancementType', to_str),
+        ('enhancement_value', 'EnhancementValue', to_number),
+        ('market_price', 'MarketPrice', to_int),
+        ('fair_price', 'FairPrice', to_int),
+        ('ingredients', 'Ingredients', to_str),
+        ('missile_design_id', 'MissileDesignId', to_int),
+        ('craft_design_id', 'CraftDesignId', to_int),
+        ('character_design_id', 'CharacterDesignId', to_int))
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class ResearchDesign(Design):
+    TAG = 'ResearchDesign'
+    FIELDS = (
+        ('id', 'ResearchDesignId', to_int),
+        ('name', 'ResearchName', to_str),
+        ('description', 'ResearchDescription', to_str),
+        ('research_time', 'ResearchTime', to_int),
+        ('gas_cost', 'GasCost', to_int),
+        ('starbux_cost', 'StarbuxCost', to_int),
+        ('required_lab_level', 'RequiredLabLevel', to_int),
+        ('required_research_id', 'RequiredResearchDesignId', to_int),
+        ('required_item_id', 'RequiredItemDesignId', to_int))
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class RoomDesign(Design):
+    TAG = 'RoomDesign'
+    FIELDS = (
+        ('id', 'RoomDesignId', to_int),
+        ('name', 'RoomName', to_str),
+        ('description', 'RoomDescription', to_str),
+        ('category_type', 'CategoryType', to_str),
+        ('room_type', 'RoomType', to_str),
+        ('level', 'Level', to_int),
+        ('mineral_cost', 'MineralCost', to_int),
+        ('gas_cost', 'GasCost', to_int),
+        ('price_string', 'PriceString', to_str),
+        ('construction_time', 'ConstructionTime', to_int),
+        ('upgrade_from_id', 'UpgradeFromRoomDesignId', to_int),
+        ('root_room_id', 'RootRoomDesignId', to_int),
+        ('min_ship_level', 'MinShipLevel', to_int))
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+class CollectionDesign(Design):
+    TAG = 'CollectionDesign'
+    FIELDS = (
+        ('id', 'CollectionDesignId', to_int),
+        ('name', 'CollectionName', to_str),
+        ('description', 'CollectionDescription', to_str),
+        ('collection_type', 'CollectionType', to_str),
+        ('min_combo', 'MinCombo', to_int),
+        ('max_combo', 'MaxCombo', to_int),
+        ('enhancement_type', 'EnhancementType', to_str),
+        ('base_enhancement_value', 'BaseEnhancementValue', to_number),
+        ('step_enhancement_value', 'StepEnhancementValue', to_number))
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+
+# ----- Indexes -------------------------------------------------------
+class DesignIndex(object):
+    """The designs of one type in API order, indexed by id and by name.
+    When names are duplicated, by_name holds the last one (as the dicts
+    keyed by name always did)"""
+    __slots__ = ('design_type', 'designs', 'by_id', 'by_name')
+
+    def __init__(self, design_type, designs):
+        self.design_type = design_type
+        self.designs = designs
+        self.by_id = {d.id: d for d in designs}
+        self.by_name = {d.name: d for d in designs}
+
+    @classmethod
+    def from_xml(cls, design_type, raw_text):
+        records = core.iter_xml_records(raw_text, tag=design_type.TAG)
+        return cls(design_type, [design_type.from_record(r) for r in records])
+
+    def __len__(self):
+        return len(self.designs)
+
+    def __iter__(self):
+        return iter(self.designs)
+
+    def to_df(self):
+        """DataFrame with the XML attribute names as columns"""
+        columns = [attrib for _, attrib, _ in self.design_type.FIELDS]
+        rows = [[getattr(d, slot) for slot, _, _ in self.design_type.FIELDS]
+                for d in self.designs]
+        return pd.DataFrame(rows, columns=columns)
+
+
+# ----- Snapshots -----------------------------------------------------
+# A snapshot holds the parsed records of one design type together with
+# the hash of the XML they were parsed from:
+#   magic (8 bytes), version (uint16), source hash (40 bytes), pickle
+SNAPSHOT_MAGIC = b'PSSDSNAP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sH40s')
+SNAPSHOT_FILE = 'pss-{}.snapshot'
+
+
+def get_snapshot_filename(design_type):
+    return SNAPSHOT_FILE.format(design_type.__name__.lower())
+
+
+def save_snapshot(index, source_hash, filename=None):
+    if filename is None:
+        filename = get_snapshot_filename(index.design_type)
+    slots = [slot for slot, _, _ in index.design_type.FIELDS]
+    rows = [tuple(getattr(d, slot) for slot in slots) for d in index.designs]
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, source_hash.encode('ascii'))
+    with core.open_atomic(filename, 'wb') as f:
+        f.write(header)
+        pickle.dump((slots, rows), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _index_from_rows(design_type, slots, rows):
+    designs = []
+    new = design_type.__new__
+    for row in rows:
+        design = new(design_type)
+        for slot, value in zip(slots, row):
+            setattr(design, slot, value)
+        designs.append(design)
+    return DesignIndex(design_type, designs)
+
+
+def load_snapshot(design_type, source_hash=None, filename=None):
+    """Returns the DesignIndex stored in the snapshot, or None if there is
+    no snapshot, it was written by another SNAPSHOT_VERSION or for another
+    set of fields, or (when source_hash is given) it is out of date"""
+    if filename is None:
+        filename = get_snapshot_filename(design_type)
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < SNAPSHOT_HEADER.size:
+        return None
+    magic, version, snapshot_hash = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        return None
+    if source_hash is not None and \
+            snapshot_hash.decode('ascii') != source_hash:
+        return None
+    with memoryview(data) as view:
+        slots, rows = pickle.loads(view[SNAPSHOT_HEADER.size:])
+
+    if slots != [slot for slot, _, _ in design_type.FIELDS]:
+        return None
+    return _index_from_rows(design_type, slots, rows)
+
+
+# ----- Registry ------------------------------------------------------
+# One index per design type, rebuilt only when the raw text changes.
+# Parsed indexes are also written to snapshots, so that a restart with
+# unchanged XML skips parsing altogether
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_source_hash(raw_text):
+    return hashlib.sha1(raw_text.encode('utf-8')).hexdigest()
+
+
+def get_index(design_type, raw_text):
+    source_hash = get_source_hash(raw_text)
+    with _registry_lock:
+        entry = _registry.get(design_type)
+    if entry is not None and entry[0] == source_hash:
+        return entry[1]
+
+    index = load_snapshot(design_type, source_hash)
+    if index is None:
+        index = DesignIndex.from_xml(design_type, raw_text)
+        try:
+            save_snapshot(index, source_hash)
+        except OSError as e:
+            print('Could not save the {} snapshot: {}'.format(
+                design_type.__name__, e))
+    with _registry_lock:
+        _registry[design_type] = (source_hash, index)
+    return index
+
+
+def get_characters(raw_text):
+    return get_index(CharacterDesign, raw_text)
+
+
+def get_items(raw_text):
+    return get_index(ItemDesign, raw_text)
+
+
+def get_research(raw_text):
+    return get_index(ResearchDesign, raw_text)
+
+
+def get_rooms(raw_text):
+    return get_index(RoomDesign, raw_text)
+
+
+def get_collections(raw_text):
+    return get_index(CollectionDesign, raw_text)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Pixel Starships Fleet History
+#
+# Score and Trophy of the division fleets, recorded at regular intervals
+# into typed arrays, for star rates, rank changes and projections
+
+
+# ----- Packages ------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+import random
+import threading
+import time
+
+import pss_array_history as ah
+import pss_core as core
+import pss_fleets as flt
+
+
+HISTORY_FILE = 'pss-fleet-history.npz'
+SNAPSHOT_INTERVAL = 15*60
+# Each snapshot is taken after SNAPSHOT_INTERVAL +/- this fraction of it
+SNAPSHOT_JITTER = 0.1
+# Hours of history used for the star rates
+RATE_HOURS = 6
+# Score or Trophy of a fleet missing from a snapshot
+MISSING = -1
+COLUMNS = ('Score', 'Trophy', 'DivisionDesignId')
+DIVISIONS = {'A': 1, 'B': 2, 'C': 3, 'D': 4}
+MESSAGE_CHARACTER_LIMIT = 2000
+
+
+# ----- History -------------------------------------------------------
+class FleetHistory(ah.ArrayHistory):
+    """[snapshot, alliance] int32 arrays, one per column of COLUMNS, with
+    the snapshot times (seconds, sorted) and AllianceIds (sorted, as ids)
+    along the axes. names holds the latest name of each alliance"""
+
+    COLUMNS = COLUMNS
+    MISSING = MISSING
+    ID_KEY = 'alliance_ids'
+
+    def __init__(self, times=None, alliance_ids=None, names=None, values=None):
+        super(FleetHistory, self).__init__(times, alliance_ids, values)
+        self.names = np.array([], dtype=object) if names is None else names.astype(object)
+
+    def _add_ids(self, ids):
+        old_columns = super(FleetHistory, self)._add_ids(ids)
+        if old_columns is not None:
+            names = np.full(len(self.ids), '', dtype=object)
+            names[old_columns] = self.names
+            self.names = names
+        return old_columns
+
+    def add(self, snapshot_time, df_ranking):
+        """Appends a snapshot of the fleets of df_ranking (a crawl_ranking
+        table)"""
+        alliance_ids = df_ranking['AllianceId'].to_numpy(dtype=np.int64)
+        with self.lock:
+            super(FleetHistory, self).add(
+                snapshot_time, alliance_ids,
+                {column: df_ranking[column].to_numpy() for column in COLUMNS})
+            columns = np.searchsorted(self.ids, alliance_ids)
+            self.names[columns] = df_ranking['AllianceName'].to_numpy(dtype=object)
+
+    def to_arrays(self):
+        arrays = super(FleetHistory, self).to_arrays()
+        arrays['names'] = self.names.astype(str)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, data):
+        values = {column: data[column] for column in COLUMNS}
+        return cls(data[cls.TIME_KEY], data[cls.ID_KEY], data['names'], values)
+
+    def get_division(self, division_id, hours=RATE_HOURS, now=None):
+        """DataFrame of the fleets of a division in the latest snapshot
+        (at or before now), with the stars they gained per hour over the
+        last hours and their rank then and now"""
+        with self.lock:
+            if len(self.times) == 0:
+                return None
+            i_new = len(self.times) - 1 if now is None else self.get_row(now)
+            if i_new is None:
+                return None
+            # The oldest snapshot in the window (the first one if the
+            # history is shorter than the window)
+            i_old = self.get_row(self.times[i_new] - hours*3600)
+            if i_old is None:
+                i_old = 0
+            elapsed = (self.times[i_new] - self.times[i_old]) / 3600
+            m = self.values['DivisionDesignId'][i_new] == division_id
+            df = pd.DataFrame({
+                'AllianceId': self.ids[m],
+                'AllianceName': self.names[m],
+                'Score': self.values['Score'][i_new, m],
+                'OldScore': self.values['Score'][i_old, m],
+                'Trophy': self.values['Trophy'][i_new, m]})
+            snapshot_time = self.times[i_new]
+
+        df['Rank'] = df['Score'].rank(ascending=False, method='min').astype(int)
+        old_scores = df['OldScore'].where(df['OldScore'] != MISSING)
+        df['OldRank'] = old_scores.rank(ascending=False, method='min')
+        if elapsed > 0:
+            df['StarsPerHour'] = (df['Score'] - old_scores) / elapsed
+        else:
+            df['StarsPerHour'] = np.nan
+        df.attrs['time'] = snapshot_time
+        df.attrs['hours'] = elapsed
+        return df.sort_values('Rank')
+
+
+def get_tournament_end(now=None):
+    """Tournaments end at the end of the month (UTC)"""
+    if now is None:
+        now = time.time()
+    today = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+    year, month = (today.year + 1, 1) if today.month == 12 else (today.year, today.month + 1)
+    end = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+    return end.timestamp()
+
+
+def project_division(df, end_time=None):
+    """Adds the projected score at the end of the tournament, assuming
+    each fleet keeps its current rate"""
+    if end_time is None:
+        end_time = get_tournament_end(df.attrs['time'])
+    hours_left = max(0, end_time - df.attrs['time']) / 3600
+    df['Projected'] = df['Score'] + df['StarsPerHour'].fillna(0)*hours_left
+    df['ProjectedRank'] = df['Projected'].rank(ascending=False, method='min').astype(int)
+    return df
+
+
+# ----- Storage -------------------------------------------------------
+def get_history():
+    return ah.get_history(FleetHistory, HISTORY_FILE)
+
+
+# ----- Snapshots -----------------------------------------------------
+def record_snapshot(filename=HISTORY_FILE):
+    """Downloads the division pages of the ranking once and records the
+    division fleets. Nothing is recorded when the pages could not be
+    downloaded, as every fleet would look gone"""
+    df_divisions = flt.crawl_divisions()
+    if len(df_divisions) == 0:
+        print('No division fleets downloaded, the snapshot is skipped')
+        return df_divisions
+    history = get_history()
+    history.add(time.time(), df_divisions)
+    ah.save_history(history, filename)
+    return df_divisions
+
+
+def start_snapshotter(interval=SNAPSHOT_INTERVAL, jitter=SNAPSHOT_JITTER):
+    """Records a snapshot every interval from a daemon thread"""
+    def refresh():
+        while True:
+            try:
+                record_snapshot()
+            except Exception as e:
+                print('Fleet snapshot failed: {}'.format(e))
+            time.sleep(interval*random.uniform(1 - jitter, 1 + jitter))
+
+    thread = threading.Thread(target=refresh, name='fleet-snapshots', daemon=True)
+    thread.start()
+    return thread
+
+
+# ----- Text ----------------------------------------------------------
+def rank_change_to_txt(rank, old_rank):
+    if np.isnan(old_rank) or old_rank == rank:
+        return ''
+    elif old_rank > rank:
+        return ' ▲{}'.format(int(old_rank - rank))
+    else:
+        return ' ▼{}'.format(int(rank - old_rank))
+
+
+def lines_to_messages(lines):
+    """Joins the lines into as few messages as fit the Discord limit"""
+    txt_list = []
+    txt = ''
+    for line in lines:
+        if len(txt) > 0 and len(txt) + 1 + len(line) > MESSAGE_CHARACTER_LIMIT:
+            txt_list.append(txt)
+            txt = line
+        else:
+            txt = line if len(txt) == 0 else txt + '\n' + line
+    txt_list.append(txt)
+    return txt_list
+
+
+def get_plain_division_stars(division, history):
+    """Scores of the division fleets in the latest snapshot. The first
+    snapshot is recorded if there is none yet"""
+    df = history.get_division(DIVISIONS[division])
+    if df is None:
+        record_snapshot()
+        df = history.get_division(DIVISIONS[division])
+    if df is None or len(df) == 0:
+        return ['No fleets found in division {}'.format(division)]
+    return lines_to_messages(['{}⭐ {}'.format(row.Score, row.AllianceName)
+                              for row in df.itertuples()])
+
+
+# Rendered tables by (division, time of the latest snapshot)
+_division_txt_cache = core.SingleFlightCache(flt.RANKING_CACHE_TTL)
+
+
+def get_division_stars(division):
+    """Division table with the stars per hour, rank changes and the
+    projected score at the end of the tournament, as a list of messages.
+    Falls back to the plain table until two snapshots have been recorded"""
+    division = division.upper()
+    if division not in DIVISIONS.keys():
+        return ['Division has to be A, B, C, or D']
+    history = get_history()
+    with history.lock:
+        n_snapshots = len(history.times)
+        latest = history.times[-1] if n_snapshots > 0 else None
+    if n_snapshots < 2:
+        return get_plain_division_stars(division, history)
+    return _division_txt_cache.get(
+        (division, latest), lambda: division_to_txt(history, division))
+
+
+def division_to_txt(history, division):
+    df = history.get_division(DIVISIONS[division])
+    if df is None or len(df) == 0 or df.attrs['hours'] == 0:
+        return get_plain_division_stars(division, history)
+
+    df = project_division(df)
+    lines = []
+    for row in df.itertuples():
+        rate = '' if np.isnan(row.StarsPerHour) else ' ({:+.0f}/h, ~{:.0f})'.format(
+            row.StarsPerHour, row.Projected)
+        lines.append('{}⭐ {}{}{}'.format(
+            row.Score, row.AllianceName, rate,
+            rank_change_to_txt(row.Rank, row.OldRank)))
+    lines.append('Rates over the last {:.1f} hours, ~ projected end of tournament score'.format(
+        df.attrs['hours']))
+    return lines_to_messages(lines)
+
+
+async def get_division_stars_async(division):
+    return await core.run_in_executor(get_division_stars, division)
+
+
+# ----- Main ----------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+        'Pixel Starships Fleet History')
+    parser.add_argument('--snapshot', action='store_true',
+        help='Record a snapshot of the ranking')
+    parser.add_argument('-d', '--division', default='A')
+    args = parser.parse_args()
+
+    if args.snapshot is True:
+        # python3 pss_fleet_history.py --snapshot
+        record_snapshot()
+    # python3 pss_fleet_history.py --division B
+    for txt in get_division_stars(args.division):
+        print(txt)
@@ -8,40 +8,45 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import concurrent.futures
 import datetime
+import itertools
 import os
 import pandas as pd
 import re
+import threading
 import urllib.request
 import uuid
-import xml.etree.ElementTree
 
 import pss_core as core
 
 
-base_url = 'http://{}/'.format(core.get_production_server())
+ALLIANCE_DTYPES = {
+    'AllianceId': int,
+    'DivisionDesignId': int,
+    'NumberOfApprovedMembers': int,
+    'Score': int,
+    'Trophy': int}
+RANKING_FILE = 'pss-alliance-ranking.pkl'
+# Seconds before the local ranking is crawled again
+RANKING_TTL = 15*60
+RANKING_PAGE_SIZE = 100
+RANKING_WORKERS = 4
+# A crawl with fewer fleets than this fraction of the previous ranking is
+# taken to have been cut short by API errors, and is not used
+RANKING_MIN_FRACTION = 0.5
+# Fleets in the tournament divisions (A: 8, B: 12, C: 16, D: 64)
+DIVISION_FLEETS = 100
+# Seconds the parsed ranking and the division tables are kept in memory
+RANKING_CACHE_TTL = 60
 
 
 def alliancetxt_to_df(raw_text):
-    df = pd.DataFrame()
-    root = xml.etree.ElementTree.fromstring(raw_text)
-    for i, c in enumerate(root):
-        # print('{}: {}'.format(i, c.tag)) # ListAlliancesByRanking
-        for ii, cc in enumerate(c):
-            # print('  {}: {}'.format(ii, cc.tag)) # Alliances
-            for iii, ccc in enumerate(cc):
-                # print(ccc.tag) # Alliance
-                row = pd.DataFrame(ccc.attrib, index=[iii])
-                df = df.append(row)
-    df['DivisionDesignId'] = df['DivisionDesignId'].astype(int)
-    df['NumberOfApprovedMembers'] = df['NumberOfApprovedMembers'].astype(int)
-    df['Score'] = df['Score'].astype(int)
-    df['Trophy'] = df['Trophy'].astype(int)
-    return df
+    return core.xml_records_to_df(raw_text, dtypes=ALLIANCE_DTYPES)
 
 
 def download_top_100_raw():
-    url = base_url + 'AllianceService/ListAlliancesByRanking?skip=0&take=100'
+    url = core.get_api_base_url() + 'AllianceService/ListAlliancesByRanking?skip=0&take=100'
     return core.get_data_from_url(url)
 
 
@@ -52,6 +57,182 @@ def download_top_100():
     return df_alliances
 
 
+# ----- Ranking Crawl -------------------------------------------------
+# The full ranking (every alliance, not only the top 100) is what
+# get_ranking and this module's command line read. The bot's /stars reads
+# the division snapshots of pss_fleet_history instead, which only
+# download the division pages (crawl_divisions), so the full ranking is
+# only crawled when get_ranking is used
+def get_empty_ranking():
+    columns = {col: pd.Series([], dtype=dtype) for col, dtype in ALLIANCE_DTYPES.items()}
+    columns['AllianceName'] = pd.Series([], dtype=object)
+    columns['Ranking'] = pd.Series([], dtype=int)
+    return pd.DataFrame(columns)
+
+
+def get_ranking_url(skip, take=RANKING_PAGE_SIZE):
+    return core.get_api_base_url() + \
+        'AllianceService/ListAlliancesByRanking?skip={}&take={}'.format(skip, take)
+
+
+def download_ranking_page(skip, take=RANKING_PAGE_SIZE):
+    """Typed DataFrame of one page of the ranking, with each alliance's
+    position in the ranking as Ranking"""
+    raw_text = core.get_data_from_url_limited(get_ranking_url(skip, take))
+    df = alliancetxt_to_df(raw_text)
+    df['Ranking'] = range(skip + 1, skip + len(df) + 1)
+    return df
+
+
+def crawl_ranking(max_alliances=None, page_size=RANKING_PAGE_SIZE,
+                  workers=RANKING_WORKERS, verbose=True):
+    """Downloads the ranking page by page, `workers` pages at a time
+    within the per-host rate limit, until a page comes back short (or
+    max_alliances is reached). Returns a single typed DataFrame"""
+    pages = []
+    skip = 0
+    done = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while not done:
+            skips = []
+            for _ in range(workers):
+                if max_alliances is not None and skip >= max_alliances:
+                    break
+                skips.append(skip)
+                skip += page_size
+            if len(skips) == 0:
+                break
+            futures = [pool.submit(download_ranking_page, page_skip, page_size)
+                       for page_skip in skips]
+            for future in futures:
+                df = future.result()
+                if len(df) > 0:
+                    pages.append(df)
+                if len(df) < page_size:
+                    done = True
+
+    if len(pages) == 0:
+        return get_empty_ranking()
+    df_ranking = pd.concat(pages, ignore_index=True)
+    if max_alliances is not None:
+        df_ranking = df_ranking[df_ranking.Ranking <= max_alliances]
+    for col, dtype in ALLIANCE_DTYPES.items():
+        if col in df_ranking.columns:
+            df_ranking[col] = df_ranking[col].astype(dtype)
+    if verbose is True:
+        print('Number of fleets in the ranking downloaded: {}'.format(len(df_ranking)))
+    return df_ranking
+
+
+def crawl_divisions(page_size=RANKING_PAGE_SIZE, n_fleets=DIVISION_FLEETS):
+    """Downloads the top of the ranking page by page until it holds the
+    n_fleets fleets of the divisions (one page with the defaults) or a
+    fleet that is not in a division. Returns the fleets of the divisions"""
+    pages = []
+    n_found = 0
+    skip = 0
+    while n_found < n_fleets:
+        df = download_ranking_page(skip, page_size)
+        if len(df) == 0:
+            break
+        pages.append(df[df.DivisionDesignId > 0])
+        n_found += len(pages[-1])
+        if len(df) < page_size or (df.DivisionDesignId == 0).any():
+            break
+        skip += page_size
+    if len(pages) == 0:
+        return get_empty_ranking()
+    return pd.concat(pages, ignore_index=True)
+
+
+def save_ranking(df_ranking, filename=RANKING_FILE):
+    with core.open_atomic(filename, 'wb') as f:
+        df_ranking.to_pickle(f)
+
+
+def load_ranking(max_seconds=RANKING_TTL, filename=RANKING_FILE):
+    """The local ranking. Once it is older than max_seconds it is still
+    served while a new crawl runs in the background. When there is none
+    yet, the first crawl is started in the background and None is
+    returned until it is done"""
+    if not os.path.isfile(filename):
+        refresh_ranking_in_background()
+        return None
+    if core.is_old_file(filename, max_seconds=max_seconds, verbose=False):
+        refresh_ranking_in_background()
+    return pd.read_pickle(filename)
+
+
+_refresh_lock = threading.Lock()
+
+
+def refresh_ranking_in_background():
+    """Crawls the ranking from a daemon thread, so that no request waits
+    for it (and the executor threads stay free). Does nothing while a
+    refresh is already running"""
+    if not _refresh_lock.acquire(blocking=False):
+        return
+
+    def refresh():
+        try:
+            set_ranking(crawl_ranking(verbose=False))
+        except Exception as e:
+            print('Ranking refresh failed: {}'.format(e))
+        finally:
+            _refresh_lock.release()
+
+    thread = threading.Thread(target=refresh, name='ranking-refresh', daemon=True)
+    thread.start()
+
+
+# The ranking is cached as (version, DataFrame) and the division tables
+# by (division, version), so a table built from an older ranking is never
+# served for a newer one
+_ranking_cache = core.SingleFlightCache(RANKING_CACHE_TTL)
+_division_txt_cache = core.SingleFlightCache(RANKING_CACHE_TTL)
+_ranking_versions = itertools.count()
+
+
+def _load_ranking():
+    return next(_ranking_versions), load_ranking()
+
+
+def _get_ranking_entry():
+    return _ranking_cache.get('ranking', _load_ranking)
+
+
+def get_ranking():
+    """The local ranking, kept in memory for RANKING_CACHE_TTL, or None
+    until the first crawl is done. Concurrent callers share a single
+    load"""
+    return _get_ranking_entry()[1]
+
+
+def is_complete_ranking(df_ranking, filename=RANKING_FILE):
+    """False for an empty crawl, or one with far fewer fleets than the
+    saved ranking (pages that failed end the crawl early)"""
+    if len(df_ranking) == 0:
+        print('Ignoring an empty ranking crawl')
+        return False
+    if os.path.isfile(filename):
+        n_old = len(pd.read_pickle(filename))
+        if len(df_ranking) < RANKING_MIN_FRACTION*n_old:
+            print('Ignoring a truncated ranking crawl: {} fleets instead of {}'.format(
+                len(df_ranking), n_old))
+            return False
+    return True
+
+
+def set_ranking(df_ranking):
+    """Saves a freshly crawled ranking and serves it from now on. An
+    empty or truncated crawl is dropped and the old ranking kept"""
+    if not is_complete_ranking(df_ranking):
+        return
+    save_ranking(df_ranking)
+    _ranking_cache.set('ranking', (next(_ranking_versions), df_ranking))
+
+
+# ----- Divisions -----------------------------------------------------
 def fleet_df_to_scores(df, division_id):
     # Note: division_id is int because
     # alliancetxt_to_df converts it
@@ -68,21 +249,26 @@ def fleet_df_to_scores(df, division_id):
 
 
 def get_division_stars(division):
-    df_alliances = download_top_100()
     division_table = {'A': 1, 'B': 2, 'C': 3, 'D': 4}
     division = division.upper()
     if division not in division_table.keys():
         return 'Division has to be A, B, C, or D'
     division_id = division_table[division]
-    txt = fleet_df_to_scores(df_alliances, division_id)
-    return txt
+    version, df_alliances = _get_ranking_entry()
+    if df_alliances is None:
+        return 'The ranking is not available yet, try again in a few minutes'
+    return _division_txt_cache.get(
+        (division_id, version), lambda: fleet_df_to_scores(df_alliances, division_id))
+
+
+async def get_division_stars_async(division):
+    return await core.run_in_executor(get_division_stars, division)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--division', default='A')
-    parser.add_argument('--api', default=2)
     args = parser.parse_args()
-    txt = get_division_stars(
-        division=args.division,
-        api=args.api)
+    # python3 pss_fleets.py --division B
+    txt = get_division_stars(division=args.division)
+    print(txt)
@@ -12,18 +12,24 @@ from __future__ import unicode_literals
 
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
 import datetime
 import csv
 import numpy as np
 import os
 import pandas as pd
 import pss_core as core
+import pss_designs as designs
+import pss_market_store as market_store
 import pss_prestige as p
+import pss_price_history as price_history
+import random
 import re
-import urllib.request
+import threading
+import time
 import uuid
-import xml.etree.ElementTree
-from io import StringIO
 
 
 # Discord limits messages to 2000 characters
@@ -31,14 +37,8 @@ MESSAGE_CHARACTER_LIMIT = 2000
 API_VERSION=2
 HOME = os.getenv('HOME')
 
-base_url = 'http://{}/'.format(core.get_production_server())
-
 
 # ----- Utilities -----------------------------------------------------
-def save_raw_text(raw_text, filename):
-    with open(filename, 'w') as f:
-        f.write(raw_text)
-
 def get_base_url(api_version=1, https=False):
     if https is True:
         prefix = 'https://'
@@ -53,63 +53,53 @@ def get_base_url(api_version=1, https=False):
 
 # ----- Get Latest Version --------------------------------------------
 def get_latest_version():
-    url= base_url + 'SettingService/GetLatestVersion?language=Key=en'
-    data = urllib.request.urlopen(url).read()
-    return data.decode()
+    url= core.get_api_base_url() + 'SettingService/GetLatestVersion?language=Key=en'
+    return core.get_data_from_url(url)
 
 
 # ----- Item Designs --------------------------------------------------
 def get_item_designs():
-    url = base_url + 'ItemService/ListItemDesigns2?languageKey=en'
-    data = urllib.request.urlopen(url).read()
-    return data.decode()
+    url = core.get_api_base_url() + 'ItemService/ListItemDesigns2?languageKey=en'
+    return core.get_data_from_url(url)
+
+
+def get_item_design_filename(date=None):
+    if date is None:
+        date = datetime.datetime.now()
+    return 'data/items-{}.txt'.format(date.strftime('%Y%m%d'))
 
 
 def save_item_design_raw(raw_text):
-    now = datetime.datetime.now()
-    filename = 'data/items-{}.txt'.format(now.strftime('%Y%m%d'))
-    save_raw_text(raw_text, filename)
+    core.save_raw_text(raw_text, get_item_design_filename())
+    try:
+        price_history.record_today(raw_text)
+    except (OSError, ValueError) as e:
+        print('Could not update the price history: {}'.format(e))
+
+
+# (filename, modification time, raw text) of the last file read
+_item_design_file = (None, None, None)
 
 
 def load_item_design_raw(refresh=False):
-    now = datetime.datetime.now()
-    filename = 'data/items{}.txt'.format(now.strftime('%Y%m%d'))
+    global _item_design_file
+    filename = get_item_design_filename()
     if os.path.isfile(filename) and refresh is False:
+        mtime = os.path.getmtime(filename)
+        if _item_design_file[:2] == (filename, mtime):
+            return _item_design_file[2]
         with open(filename, 'r') as f:
             raw_text = f.read()
+        _item_design_file = (filename, mtime, raw_text)
     else:
         raw_text = get_item_designs()
         save_item_design_raw(raw_text)
+        _item_design_file = (filename, os.path.getmtime(filename), raw_text)
     return raw_text
 
 
 def parse_item_designs(raw_text):
-    d = {}
-    # r_lookup = {}
-    root = xml.etree.ElementTree.fromstring(raw_text)
-    for c in root:
-        # print(c.tag) # ListItemDesigns
-        for cc in c:
-            # print(cc.tag) # ItemDesigns
-            for ccc in cc:
-                # print(ccc.tag) # ItemDesign
-                if ccc.tag != 'ItemDesign':
-                    continue
-
-                item_name = ccc.attrib['ItemDesignName']
-                d[item_name] = ccc.attrib
-                # r_lookup[int(ccc.attrib['ItemDesignId'])] = item_name
-    return d
-
-
-def xmltext_to_df(raw_text):
-    df = pd.DataFrame()
-    root = xml.etree.ElementTree.fromstring(raw_text)
-    for c in root:
-        for cc in c:
-            for i, ccc in enumerate(cc):
-                df = df.append(pd.DataFrame(ccc.attrib, index=[i]))
-    return df
+    return designs.get_items(raw_text).by_name
 
 
 # ----- Lists ---------------------------------------------------------
@@ -134,45 +124,39 @@ def fix_item(item):
 
 
 def filter_item_designs(search_str, rtbl, filter):
-    item_original = list(rtbl.keys())
-    item_lookup = [ fix_item(s) for s in item_original ]
-    item_fixed  = fix_item(search_str)
+    index = core.get_name_index(rtbl, fix_item)
 
     txt = ''
-    for i, item_name in enumerate(item_lookup):
-
-        m = re.search(item_fixed, item_name)
-        if m is not None:
-            item_name  = item_original[i]
-            d = rtbl[item_name]
-
-            # Filter out items
-            if (item_name == 'Gas'            or
-                item_name == 'Mineral'        or
-                d['MissileDesignId']   != '0' or
-                d['CraftDesignId']     != '0' or
-                d['CharacterDesignId'] != '0'):
+    for item_name in index.search(search_str):
+        d = rtbl[item_name]
+
+        # Filter out items
+        if (item_name == 'Gas'          or
+            item_name == 'Mineral'      or
+            d.missile_design_id   != 0  or
+            d.craft_design_id     != 0  or
+            d.character_design_id != 0):
+            continue
+
+        # Process
+        # item_price = d.fair_price
+        item_price = d.market_price
+        item_slot  = re.sub('Equipment', '', d.item_sub_type)
+        item_stat  = d.enhancement_type
+        item_stat_value = d.enhancement_value
+
+        if filter == 'price':
+            if item_price == 0:
+                item_price = 'NA'
+            txt += '{}: {}\n'.format(item_name, item_price)
+        elif filter == 'stats':
+            if item_stat == 'None':
                 continue
-
-            # Process
-            # item_price = d['FairPrice']
-            item_price = d['MarketPrice']
-            item_slot  = re.sub('Equipment', '', d['ItemSubType'])
-            item_stat  = d['EnhancementType']
-            item_stat_value = d['EnhancementValue']
-
-            if filter == 'price':
-                if item_price == '0':
-                    item_price = 'NA'
-                txt += '{}: {}\n'.format(item_name, item_price)
-            elif filter == 'stats':
-                if item_stat == 'None':
-                    continue
-                txt += '{}: {} +{} ({})\n'.format(item_name,
-                    item_stat, item_stat_value, item_slot)
-            else:
-                print('Invalid filter')
-                quit()
+            txt += '{}: {} +{} ({})\n'.format(item_name,
+                item_stat, item_stat_value, item_slot)
+        else:
+            print('Invalid filter')
+            quit()
 
     if len(txt) == 0:
         return None
@@ -181,22 +165,19 @@ def filter_item_designs(search_str, rtbl, filter):
 
 
 def get_real_name(search_str, rtbl):
-    item_original = list(rtbl.keys())
-    item_lookup = [ fix_item(s) for s in item_original ]
-    item_fixed  = fix_item(search_str)
+    index = core.get_name_index(rtbl, fix_item)
 
-    try:
-        # Attempt to find an exact match
-        idx = item_lookup.index(item_fixed)
-        return item_original[idx]
-    except:
-        # Perform search if the exact match failed
-        m = [ re.search(item_fixed, n) is not None for n in item_lookup ]
-        item = pd.Series(item_original)[m]
-        if len(item) > 0:
-            return item.iloc[0]
-        else:
-            return None
+    # Attempt to find an exact match
+    item_name = index.find(search_str)
+    if item_name is not None:
+        return item_name
+
+    # Perform search if the exact match failed
+    matches = index.search(search_str)
+    if len(matches) > 0:
+        return matches[0]
+    else:
+        return None
 
 
 # ----- Item Stats ----------------------------------------------------
@@ -209,9 +190,40 @@ def get_item_stats(item_name):
     return market_txt
 
 
+# ----- Item Prices ---------------------------------------------------
+def get_item_price(item_name):
+    raw_text = load_item_design_raw()
+    item_lookup = parse_item_designs(raw_text)
+    real_name = get_real_name(item_name, item_lookup)
+    if real_name is None:
+        return None, None
+    market_txt = filter_item_designs(item_name, item_lookup, filter='price')
+    return market_txt, real_name
+
+
+def get_item_price_trend(item_name):
+    """Current price of an item with its change over 7 and 30 days"""
+    raw_text = load_item_design_raw()
+    item_lookup = parse_item_designs(raw_text)
+    real_name = get_real_name(item_name, item_lookup)
+    if real_name is None:
+        real_name = core.get_fuzzy_name(item_name, item_lookup, fix_item)
+    if real_name is None:
+        return None, None
+    txt = price_history.get_price_changes_txt(item_lookup[real_name].id, real_name)
+    return txt, real_name
+
+
+def get_top_movers(days=7, k=10):
+    raw_text = load_item_design_raw()
+    item_names = {d.id: d.name for d in designs.get_items(raw_text)}
+    return price_history.get_top_movers_txt(item_names, days, k)
+
+
 # ----- Best Items ----------------------------------------------------
 def rtbl2items(rtbl):
-    df_rtbl = pd.DataFrame(rtbl).T
+    df_rtbl = pd.DataFrame(
+        [d.to_record() for d in rtbl.values()], index=list(rtbl.keys()))
     m1 = df_rtbl.EnhancementType != 'None'
     m2 = df_rtbl.ItemSubType.str.contains('Equipment')
     df_items = df_rtbl[m1 & m2].copy()
@@ -243,176 +255,678 @@ def itemfilter2txt(df_filter):
     for row in df_filter.iterrows():
         data = row[1]
         mprice = data['MarketPrice']
-        if mprice == '0':
+        if mprice == 0:
             mprice = 'NA'
-        txt += '{}: {} ({} bux)\n'.format(data[0], data[1], mprice)
+        txt += '{}: {} ({} bux)\n'.format(data.iloc[0], data.iloc[1], mprice)
     return txt
 
 
-# ----- Item Recipes --------------------------------------------------
-def get_item_rlookup(df):
-    item_rlookup = {}
-    for row in df.iterrows():
-        data = row[1]
-        item_rlookup[data['ItemDesignId']] = data['ItemDesignName']
-    return item_rlookup
+class BestItemIndex(object):
+    """Equipment with an enhancement, grouped by (slot, enhancement) with
+    lower case keys as rtbl2items makes them, each group sorted by
+    EnhancementValue (highest first)"""
 
+    def __init__(self, items):
+        self.items = items
+        self.raw_text = None
+        groups = {}
+        for d in items:
+            if d.enhancement_type == 'None' or 'Equipment' not in d.item_sub_type:
+                continue
+            slot = d.item_sub_type.replace('Equipment', '').lower()
+            key = (slot, d.enhancement_type.lower())
+            groups.setdefault(key, []).append(d)
+        self.groups = {key: sorted(group, key=lambda d: -d.enhancement_value)
+                       for key, group in groups.items()}
+        slot_counts = collections.Counter()
+        enhancement_counts = collections.Counter()
+        for (slot, enhancement), group in self.groups.items():
+            slot_counts[slot] += len(group)
+            enhancement_counts[enhancement] += len(group)
+        self.slots = [slot for slot, _ in slot_counts.most_common()]
+        self.enhancements = [e for e, _ in enhancement_counts.most_common()]
+
+    def query(self, slot, enhancement, k=None, max_price=None, rarity=None):
+        """Top k items of a slot and enhancement, optionally only those
+        whose MarketPrice is known and at most max_price, or of a rarity"""
+        if slot is None or enhancement is None:
+            return []
+        group = self.groups.get((slot.lower(), enhancement.lower()), [])
+        if max_price is None and rarity is None:
+            return group[:k]
+        if rarity is not None:
+            rarity = rarity.lower()
+        found = []
+        for d in group:
+            if max_price is not None and \
+                    (d.market_price == 0 or d.market_price > max_price):
+                continue
+            if rarity is not None and d.rarity.lower() != rarity:
+                continue
+            found.append(d)
+            if k is not None and len(found) == k:
+                break
+        return found
 
-def get_recipe(df, item_rlookup, item_name):
-    ingredients = df.loc[df['ItemDesignName'] == item_name, 'Ingredients']
-    if len(ingredients) == 1:
-        ingredients = ingredients.values[0]
-        if len(ingredients) == 0:
-            return None
-        ingredients = ingredients.split('|')
-        recipe = {}
-        for ingredient in ingredients:
-            item_id, item_qty = ingredient.split('x')
-            recipe[item_rlookup[item_id]] = int(item_qty)
-        return recipe
-    else:
-        return None
+
+_best_item_index = None
 
 
-def print_recipe(recipe, df_items):
+def get_best_item_index(raw_text):
+    # Rebuilt only when the item designs change
+    global _best_item_index
+    index = _best_item_index
+    if index is not None and index.raw_text is raw_text:
+        return index
+    items = designs.get_items(raw_text)
+    if index is None or index.items is not items:
+        index = BestItemIndex(items)
+    index.raw_text = raw_text
+    _best_item_index = index
+    return index
+
+
+def best_items_to_txt(items):
+    if len(items) == 0:
+        return None
+
     txt = ''
-    total = 0
-    for ingredient in recipe.keys():
-        qty = recipe[ingredient]
-        fprice = df_items.loc[df_items['ItemDesignName'] == ingredient, 'FairPrice'].iloc[0]
-        mprice = df_items.loc[df_items['ItemDesignName'] == ingredient, 'MarketPrice'].iloc[0]
-        if mprice == '0':
-            mprice = np.nan
-            txt += '{} x {} (price: NA)\n'.format(qty, ingredient)
-        else:
-            mprice = int(mprice)
-            txt += '{} x {} ({} bux): {} bux\n'.format(qty, ingredient, mprice, qty*mprice)
-        total += qty*mprice
-    if np.isnan(total):
-        txt += 'Crafting Cost: NA'
-    else:
-        txt += 'Crafting Cost: {} bux'.format(total)
+    for d in items:
+        mprice = d.market_price
+        if mprice == 0:
+            mprice = 'NA'
+        txt += '{}: {} ({} bux)\n'.format(d.name, float(d.enhancement_value), mprice)
     return txt
 
 
-def collapse_recipe(recipe, df_items, item_rlookup):
-    collapse = False
-    sub_recipe = {}
-    for ingredient in recipe.keys():
-        qty = recipe[ingredient]
-        sub_ingredients = get_recipe(df_items, item_rlookup, ingredient)
-        if sub_ingredients is None:
-            if ingredient in sub_recipe.keys():
-                sub_recipe[ingredient] += recipe[ingredient]
+def get_best_items(slot, enhancement, k=None, max_price=None, rarity=None):
+    """Returns the text listing the best items, and the index (for the
+    list of slots and enhancements when nothing was found)"""
+    index = get_best_item_index(load_item_design_raw())
+    items = index.query(slot, enhancement, k, max_price, rarity)
+    return best_items_to_txt(items), index
+
+
+# ----- Loadouts ------------------------------------------------------
+def parse_weights(txt):
+    # 'attack,hp=0.5' -> {'attack': 1.0, 'hp': 0.5}
+    weights = {}
+    for term in txt.split(','):
+        if len(term.strip()) == 0:
+            continue
+        enhancement, _, weight = term.partition('=')
+        weights[enhancement.strip().lower()] = float(weight) if weight else 1.0
+    return weights
+
+
+def get_slot_candidates(index, slot, weights, budget=None):
+    """Pareto front of the items of a slot: (price, score, design) sorted
+    by price, where each item scores higher than every cheaper one.
+    Items without a MarketPrice cannot be bought and are left out"""
+    items = []
+    for enhancement, weight in weights.items():
+        for d in index.groups.get((slot, enhancement), []):
+            if d.market_price == 0 or (budget is not None and d.market_price > budget):
+                continue
+            items.append((d.market_price, -weight*d.enhancement_value, d.id, d))
+    items.sort()
+
+    candidates = []
+    for price, score, _, d in items:
+        score = -score
+        if score > 0 and (len(candidates) == 0 or score > candidates[-1][1]):
+            candidates.append((price, score, d))
+    return candidates
+
+
+def optimize_loadout(candidates, budget=None):
+    """Branch and bound over one candidate list per slot (as returned by
+    get_slot_candidates). Returns (score, cost, [design or None per slot])
+    with the highest score whose cost is within budget"""
+    if budget is None:
+        budget = float('inf')
+    n = len(candidates)
+    prices = [[c[0] for c in options] for options in candidates]
+    scores = [[c[1] for c in options] for options in candidates]
+    best = {'score': 0, 'cost': 0, 'choice': [None]*n}
+    choice = [None]*n
+
+    def bound(i, remaining):
+        # Best item of each remaining slot, ignoring the other slots
+        total = 0
+        for j in range(i, n):
+            k = bisect.bisect_right(prices[j], remaining)
+            if k > 0:
+                total += scores[j][k - 1]
+        return total
+
+    def search(i, score, cost):
+        if i == n:
+            if score > best['score']:
+                best.update(score=score, cost=cost, choice=list(choice))
+            return
+        remaining = budget - cost
+        if score + bound(i, remaining) <= best['score']:
+            return
+        # Highest scoring affordable items first, then leave the slot empty
+        for k in range(bisect.bisect_right(prices[i], remaining) - 1, -1, -1):
+            price, item_score, d = candidates[i][k]
+            choice[i] = d
+            search(i + 1, score + item_score, cost + price)
+        choice[i] = None
+        search(i + 1, score, cost)
+
+    search(0, 0, 0)
+    return best['score'], best['cost'], best['choice']
+
+
+def get_loadout(weights, budget=None, char_name=None):
+    """Best item for each slot the character can equip (every slot when
+    char_name is None), maximizing the weighted enhancements within a
+    budget in bux. Returns (text, success)"""
+    slots = [p.equipment_lookup[k] for k in sorted(p.equipment_lookup)]
+    if char_name is not None:
+        ctbl, _, tbl_n2i, _ = p.get_char_sheet()
+        char_id, char_name = p.char2id(char_name, tbl_n2i)
+        if char_id is None:
+            return "Could not find character named '{}'".format(char_name), False
+        mask = ctbl[char_id].equipment_mask
+        slots = [p.equipment_lookup[k] for k in sorted(p.equipment_lookup)
+                 if mask & k != 0]
+        if len(slots) == 0:
+            return '{} cannot equip items'.format(char_name), False
+
+    index = get_best_item_index(load_item_design_raw())
+    candidates = [get_slot_candidates(index, slot, weights, budget)
+                  for slot in slots]
+    score, cost, choice = optimize_loadout(candidates, budget)
+    if score == 0:
+        return 'No items found for {}'.format(', '.join(weights)), False
+
+    txt = '**Loadout for {}**\n'.format(
+        'all slots' if char_name is None else char_name)
+    for slot, d in zip(slots, choice):
+        if d is None:
+            txt += '{}: -\n'.format(slot)
+        else:
+            txt += '{}: {} ({} +{}, {} bux)\n'.format(
+                slot, d.name, d.enhancement_type, d.enhancement_value, d.market_price)
+    txt += 'Total: {:g} for {} bux'.format(score, cost)
+    return txt, True
+
+
+# ----- Item Recipes --------------------------------------------------
+def get_item_rlookup(df):
+    return dict(zip(df['ItemDesignId'], df['ItemDesignName']))
+
+
+def parse_ingredients(ingredients):
+    # '172x2|173x1' -> {172: 2, 173: 1}
+    recipe = {}
+    if len(ingredients) == 0:
+        return recipe
+    for ingredient in ingredients.split('|'):
+        item_id, item_qty = ingredient.split('x')
+        item_id = int(item_id)
+        recipe[item_id] = recipe.get(item_id, 0) + int(item_qty)
+    return recipe
+
+
+# Recipe levels kept for a design that (indirectly) needs itself, whose
+# recipe never collapses to raw materials
+RECIPE_MAX_LEVELS = 10
+
+
+class RecipeGraph(object):
+    """Recipe DAG of the item designs, built once from the Ingredients
+    field and keyed by ItemDesignId. The raw materials and crafting cost,
+    the level by level breakdown and the where-used lists are memoized
+    per item, so a query only walks its own tree once"""
+
+    def __init__(self, items):
+        self.items = items
+        # MarketPrice, falling back to FairPrice (nan when neither is set)
+        self.prices = dict(zip((d.id for d in items), get_item_prices(items)))
+        self.recipes = {}
+        # Inverted index: {ingredient id: {item id: quantity}}
+        self.used_in = {}
+        for d in items:
+            recipe = parse_ingredients(d.ingredients)
+            if len(recipe) > 0:
+                self.recipes[d.id] = recipe
+                for sub_id, qty in recipe.items():
+                    self.used_in.setdefault(sub_id, {})[d.id] = qty
+        self._raw = {}
+        self._costs = {}
+        self._uses = {}
+        self._levels = {}
+
+    def get_recipe(self, item_id):
+        return self.recipes.get(item_id)
+
+    def collapse(self, recipe):
+        """Expands the craftable ingredients by one level, or returns None
+        if every ingredient is a raw material"""
+        collapse = False
+        sub_recipe = {}
+        for item_id, qty in recipe.items():
+            sub_ingredients = self.recipes.get(item_id)
+            if sub_ingredients is None:
+                sub_recipe[item_id] = sub_recipe.get(item_id, 0) + qty
+            else:
+                for sub_id, sub_qty in sub_ingredients.items():
+                    sub_recipe[sub_id] = sub_recipe.get(sub_id, 0) + qty*sub_qty
+                collapse = True
+        return sub_recipe if collapse is True else None
+
+    def get_raw_materials(self, item_id):
+        """{raw ItemDesignId: quantity} needed to craft one item_id
+        ({item_id: 1} for a raw material), or None if item_id needs a
+        design that (indirectly) needs itself"""
+        return self._find_raw_materials(item_id, set())
+
+    def _find_raw_materials(self, item_id, visiting):
+        if item_id in self._raw:
+            return self._raw[item_id]
+        recipe = self.recipes.get(item_id)
+        if recipe is None:
+            return {item_id: 1}
+        # Reaching an item that is being expanded means it needs itself,
+        # so every item on the way has no finite bill either
+        if item_id in visiting:
+            return None
+        visiting.add(item_id)
+        raw = {}
+        for sub_id, qty in recipe.items():
+            sub_raw = self._find_raw_materials(sub_id, visiting)
+            if sub_raw is None:
+                raw = None
+                break
+            for raw_id, raw_qty in sub_raw.items():
+                raw[raw_id] = raw.get(raw_id, 0) + qty*raw_qty
+        visiting.discard(item_id)
+        self._raw[item_id] = raw
+        return raw
+
+    def get_cost(self, item_id):
+        """Crafting cost of one item_id from its raw materials (nan if one
+        of them has no price or the item needs itself). Raw materials
+        missing from the designs are left out"""
+        cost = self._costs.get(item_id)
+        if cost is None:
+            raw = self.get_raw_materials(item_id)
+            if raw is None:
+                cost = np.nan
             else:
-                sub_recipe[ingredient] = recipe[ingredient]
+                cost = sum(qty*self.prices[raw_id] for raw_id, qty in raw.items()
+                           if raw_id in self.prices)
+            self._costs[item_id] = cost
+        return cost
+
+    def get_levels(self, item_id, levels=1):
+        """The recipe of item_id followed by its collapsed levels, at most
+        `levels` in all, as get_item_recipe prints them. The levels are
+        expanded once per item, down to the raw materials (or
+        RECIPE_MAX_LEVELS for a design that needs itself)"""
+        item_levels = self._levels.get(item_id)
+        if item_levels is None:
+            raw = self.get_raw_materials(item_id)
+            max_levels = RECIPE_MAX_LEVELS if raw is None else len(self.recipes)
+            item_levels = []
+            recipe = self.recipes.get(item_id)
+            while recipe is not None and len(item_levels) < max_levels:
+                item_levels.append(recipe)
+                recipe = self.collapse(recipe)
+            self._levels[item_id] = item_levels
+        return item_levels[:levels]
+
+    def get_uses(self, item_id):
+        """{ItemDesignId: quantity of item_id per craft} of every item that
+        needs item_id, directly or through other recipes"""
+        uses = self._uses.get(item_id)
+        if uses is None:
+            uses, _ = self._find_uses(item_id, set())
+            self._uses[item_id] = uses
+        return uses
+
+    def _find_uses(self, item_id, visiting):
+        """(uses, complete) of item_id. The walk stops at an item that is
+        already being visited (a design that indirectly needs itself);
+        the uses found below such a cut depend on where the walk started,
+        so they are only memoized when complete"""
+        uses = self._uses.get(item_id)
+        if uses is not None:
+            return uses, True
+        if item_id in visiting:
+            return {}, False
+        visiting.add(item_id)
+        uses = {}
+        complete = True
+        for parent_id, qty in self.used_in.get(item_id, {}).items():
+            uses[parent_id] = uses.get(parent_id, 0) + qty
+            parent_uses, parent_complete = self._find_uses(parent_id, visiting)
+            complete = complete and parent_complete
+            for ancestor_id, parent_qty in parent_uses.items():
+                uses[ancestor_id] = uses.get(ancestor_id, 0) + qty*parent_qty
+        visiting.discard(item_id)
+        if complete is True:
+            self._uses[item_id] = uses
+        return uses, complete
+
+    def get_price(self, item_id):
+        mprice = self.items.by_id[item_id].market_price
+        return np.nan if mprice == 0 else mprice
+
+    def recipe_to_txt(self, recipe):
+        txt = ''
+        total = 0
+        for item_id, qty in recipe.items():
+            ingredient = self.items.by_id[item_id].name
+            mprice = self.get_price(item_id)
+            if np.isnan(mprice):
+                txt += '{} x {} (price: NA)\n'.format(qty, ingredient)
+            else:
+                txt += '{} x {} ({} bux): {} bux\n'.format(qty, ingredient, mprice, qty*mprice)
+            total += qty*mprice
+        if np.isnan(total):
+            txt += 'Crafting Cost: NA'
         else:
-            for sub_ingredient in sub_ingredients:
-                if sub_ingredient in sub_recipe.keys():
-                    sub_recipe[sub_ingredient] += qty * sub_ingredients[sub_ingredient]
-                else:
-                    sub_recipe[sub_ingredient] = qty * sub_ingredients[sub_ingredient]
-            collapse = True
-        # print('{} x {}: {}'.format(qty, ingredient, sub_ingredients))
-    if collapse is True:
-        return sub_recipe
-    else:
-        return None
+            txt += 'Crafting Cost: {} bux'.format(total)
+        return txt
+
+
+_recipe_graph = None
+
+
+def get_recipe_graph(raw_text):
+    # Rebuilt only when the item designs change
+    global _recipe_graph
+    items = designs.get_items(raw_text)
+    graph = _recipe_graph
+    if graph is None or graph.items is not items:
+        graph = RecipeGraph(items)
+        _recipe_graph = graph
+    return graph
 
 
 def get_multi_recipe(name, levels=1):
     raw_text = load_item_design_raw()
     item_lookup = parse_item_designs(raw_text)
     real_name = get_real_name(name, item_lookup)
+    if real_name is None:
+        return ''
 
-    df_items = xmltext_to_df(raw_text)
-    item_rlookup = get_item_rlookup(df_items)
-    recipe = get_recipe(df_items, item_rlookup, real_name)
+    graph = get_recipe_graph(raw_text)
+    recipes = graph.get_levels(item_lookup[real_name].id, levels)
+    return '\n\n'.join(graph.recipe_to_txt(recipe) for recipe in recipes)
 
-    txt = ''
-    level = 1
-    while recipe is not None:
-        txt += print_recipe(recipe, df_items)
-        recipe = collapse_recipe(recipe, df_items, item_rlookup)
-        level += 1
-        if level > levels:
-            break
-        if recipe is not None:
-            txt += '\n\n'
-    return txt
 
-
-def get_item_recipe(name, levels=5):
+def get_item_recipe(name, levels=5, fuzzy=True):
     raw_text = load_item_design_raw()
     item_lookup = parse_item_designs(raw_text)
     # print('name = {}'.format(name))
     real_name = get_real_name(name, item_lookup)
+    if real_name is None and fuzzy is True:
+        real_name = core.get_fuzzy_name(name, item_lookup, fix_item)
     # print('real_name = {}'.format(real_name))
+    content = None
     if real_name is not None:
         content = get_multi_recipe(real_name, levels)
     return content, real_name
 
 
+def uses_to_txt(uses, graph, title):
+    """The title and the items of uses, as messages below the Discord
+    limit"""
+    names = ['{} x{}'.format(graph.items.by_id[item_id].name, qty)
+             for item_id, qty in sorted(uses.items(), key=lambda x: graph.items.by_id[x[0]].name)]
+    names[0] = '**{}**\n{}'.format(title, names[0])
+    return core.list_to_text(names, MESSAGE_CHARACTER_LIMIT - 100)
+
+
+def get_item_uses(name, fuzzy=True):
+    """Items that can be crafted with an item, directly and through other
+    recipes, with the quantity needed for one craft"""
+    raw_text = load_item_design_raw()
+    item_lookup = parse_item_designs(raw_text)
+    real_name = get_real_name(name, item_lookup)
+    if real_name is None and fuzzy is True:
+        real_name = core.get_fuzzy_name(name, item_lookup, fix_item)
+    if real_name is None:
+        return None, None
+
+    graph = get_recipe_graph(raw_text)
+    item_id = item_lookup[real_name].id
+    direct = graph.used_in.get(item_id, {})
+    indirect = {k: v for k, v in graph.get_uses(item_id).items()
+                if k not in direct}
+    if len(direct) == 0:
+        return ['{} is not used in any recipe'.format(real_name)], real_name
+
+    content = uses_to_txt(direct, graph, 'Crafted with {}'.format(real_name))
+    if len(indirect) > 0:
+        content += uses_to_txt(indirect, graph, 'Through other recipes')
+    return content, real_name
+
+
+# ----- Crafting Arbitrage --------------------------------------------
+def get_item_prices(items):
+    # MarketPrice, falling back to FairPrice (nan when neither is set)
+    prices = np.array([d.market_price if d.market_price != 0 else d.fair_price
+                       for d in items], dtype=float)
+    prices[prices == 0] = np.nan
+    return prices
+
+
+def get_crafting_table(raw_text=None):
+    """DataFrame of every craftable item with its crafting cost from raw
+    materials, its own price and the margin of crafting it, most
+    profitable first. The costs are memoized in the recipe graph, so the
+    catalogue is only solved once per item design snapshot"""
+    if raw_text is None:
+        raw_text = load_item_design_raw()
+    graph = get_recipe_graph(raw_text)
+    item_ids = sorted(graph.recipes)
+    item_prices = np.array([graph.prices[item_id] for item_id in item_ids])
+    costs = np.array([graph.get_cost(item_id) for item_id in item_ids], dtype=float)
+    df = pd.DataFrame({
+        'ItemDesignId': item_ids,
+        'ItemDesignName': [graph.items.by_id[item_id].name for item_id in item_ids],
+        'Price': item_prices,
+        'CraftingCost': costs,
+        'Margin': item_prices - costs})
+    df = df.dropna(subset=['Margin'])
+    return df.sort_values('Margin', ascending=False)
+
+
+def get_profitable_crafts(n=10):
+    """The n most profitable crafts as a list of messages, or None"""
+    df = get_crafting_table().head(n)
+    lines = ['**Most profitable crafts**']
+    for row in df.itertuples():
+        lines.append('{}: {:,.0f} bux profit (sells for {:,.0f}, crafts for {:,.0f})'.format(
+            row.ItemDesignName, row.Margin, row.Price, row.CraftingCost))
+    if len(lines) == 1:
+        return None
+    return core.list_to_text(lines, MESSAGE_CHARACTER_LIMIT - 100, sep='\n')
+
+
 # ----- Market Data ---------------------------------------------------
-def request_new_market_data(token, subtype='None', rarity='None'):
-    # Download Market Data from PSS Servers
+def get_market_url(token, subtype='None', rarity='None'):
     txt_subtype='?itemSubType={}'.format(subtype)
     txt_rarity='&rarity={}'.format(rarity)
     txt_token='&accessToken={}'.format(token)
-    url = base_url + 'MessageService/ListActiveMarketplaceMessages2' + txt_subtype \
+    return core.get_api_base_url() + 'MessageService/ListActiveMarketplaceMessages2' + txt_subtype \
         + txt_rarity + txt_token
+
+
+def request_new_market_data(token, subtype='None', rarity='None'):
+    # Download Market Data from PSS Servers
+    url = get_market_url(token, subtype, rarity)
     print('Downloading market data from url="{}"'.format(url))
-    data = urllib.request.urlopen(url).read()
-    return data.decode()
+    return core.get_data_from_url(url)
 
 
 def process_market_data(mkt_data):
-    # Process Character Sheet to CSV format
-    tree = xml.etree.ElementTree.parse(StringIO(mkt_data))
-    root = tree.getroot()
     market_txt = ''
-    for c in root.findall('ListActiveMarketplaceMessages'):
-        for cc in c.findall('Messages'):
-            for ccc in cc.findall('Message'):
-                mssg_id = ccc.attrib['MessageId']
-                user_id = ccc.attrib['UserId']
-                message = ccc.attrib['Message']
-                user_nm = ccc.attrib['UserName']
-                user_sp = ccc.attrib['UserSpriteId']
-                mssg_tp = ccc.attrib['MessageType']
-                channel = ccc.attrib['ChannelId']
-                actv_tp = ccc.attrib['ActivityType']
-                actv_ar = ccc.attrib['ActivityArgument']
-                mssg_dt = ccc.attrib['MessageDate']
-                unit, cost = actv_ar.split(':')
-                txt = '{}: {} for {} {}\n'.format(
-                    user_nm, message, cost, unit)
-                market_txt += txt
+    for record in core.iter_xml_records(mkt_data, tag='Message'):
+        message = record['Message']
+        user_nm = record['UserName']
+        unit, cost = record['ActivityArgument'].split(':')
+        txt = '{}: {} for {} {}\n'.format(
+            user_nm, message, cost, unit)
+        market_txt += txt
     return market_txt
 
 
 def get_market_data(subtype, rarity):
     token = str(uuid.uuid4())
     mkt_data = request_new_market_data(token, subtype, rarity)
+    # Keep the listings for the price history, which must not break the
+    # reply
+    try:
+        market_store.get_store().ingest(mkt_data)
+    except Exception as e:
+        print('Could not store the market listings: {}'.format(e))
     market_txt = process_market_data(mkt_data)
     return market_txt
 
 
+# ----- Market Poller -------------------------------------------------
+POLL_WORKERS = 4
+POLL_INTERVAL = 15*60
+# Each pass starts after POLL_INTERVAL +/- this fraction of it
+POLL_JITTER = 0.2
+
+
+def get_market_queries(raw_text=None):
+    """Every (subtype, rarity) pair of the items that can be sold"""
+    if raw_text is None:
+        raw_text = load_item_design_raw()
+    subtypes = set()
+    rarities = set()
+    for d in designs.get_items(raw_text):
+        if d.item_sub_type != 'None':
+            subtypes.add(d.item_sub_type)
+        if d.rarity != 'None':
+            rarities.add(d.rarity)
+    return [(subtype, rarity)
+            for subtype in sorted(subtypes) for rarity in sorted(rarities)]
+
+
+def poll_market(queries=None, store=None, workers=POLL_WORKERS, verbose=True):
+    """Downloads the listings of every query, at most `workers` at a time
+    and within the per-host rate limit, and stores the new ones. Returns
+    the number of new listings"""
+    if queries is None:
+        queries = get_market_queries()
+    if store is None:
+        store = market_store.get_store()
+    queries = list(queries)
+    # Spread the load differently on each pass
+    random.shuffle(queries)
+
+    def poll(query):
+        subtype, rarity = query
+        url = get_market_url(str(uuid.uuid4()), subtype, rarity)
+        return store.ingest(core.get_data_from_url_limited(url))
+
+    n_new = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(poll, query): query for query in queries}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                n_new += future.result()
+            except Exception as e:
+                print('Market poll of {} failed: {}'.format(futures[future], e))
+    if verbose is True:
+        print('Market poller: {} new listings from {} queries'.format(
+            n_new, len(queries)))
+    return n_new
+
+
+def start_market_poller(interval=POLL_INTERVAL, jitter=POLL_JITTER):
+    """Keeps the market store fresh from a daemon thread"""
+    def refresh():
+        while True:
+            try:
+                poll_market(verbose=False)
+            except Exception as e:
+                print('Market poller failed: {}'.format(e))
+            time.sleep(interval*random.uniform(1 - jitter, 1 + jitter))
+
+    thread = threading.Thread(target=refresh, name='market-poller', daemon=True)
+    thread.start()
+    return thread
+
+
 # ----- Lists ---------------------------------------------------------
 def get_item_list():
     raw_text = load_item_design_raw()
-    df_items = xmltext_to_df(raw_text)
+    df_items = designs.get_items(raw_text).to_df()
     items = list(df_items['ItemDesignName'])
     # print('List of items: ' + ', '.join(items))
     return core.list_to_text(items)
 
 
+# ----- Async ---------------------------------------------------------
+async def load_item_design_raw_async(refresh=False):
+    return await core.run_in_executor(load_item_design_raw, refresh)
+
+
+async def get_item_price_async(item_name):
+    return await core.run_in_executor(get_item_price, item_name)
+
+
+async def get_item_stats_async(item_name):
+    return await core.run_in_executor(get_item_stats, item_name)
+
+
+async def get_item_recipe_async(name, levels=5, fuzzy=True):
+    return await core.run_in_executor(get_item_recipe, name, levels, fuzzy)
+
+
+async def get_item_price_trend_async(item_name):
+    return await core.run_in_executor(get_item_price_trend, item_name)
+
+
+async def get_top_movers_async(days=7, k=10):
+    return await core.run_in_executor(get_top_movers, days, k)
+
+
+async def get_best_items_async(slot, enhancement, k=None, max_price=None, rarity=None):
+    return await core.run_in_executor(
+        get_best_items, slot, enhancement, k, max_price, rarity)
+
+
+async def get_loadout_async(weights, budget=None, char_name=None):
+    return await core.run_in_executor(get_loadout, weights, budget, char_name)
+
+
+async def get_item_uses_async(name, fuzzy=True):
+    return await core.run_in_executor(get_item_uses, name, fuzzy)
+
+
+async def get_profitable_crafts_async(n=10):
+    return await core.run_in_executor(get_profitable_crafts, n)
+
+
+async def get_market_data_async(subtype, rarity):
+    return await core.run_in_executor(get_market_data, subtype, rarity)
+
+
+async def get_item_list_async():
+    return await core.run_in_executor(get_item_list)
+
+
 # ----- Main ----------------------------------------------------------
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=
         'Pixel Starships Market API')
     parser.add_argument('--market', action='store_true',
         help='Get Market Data')
+    parser.add_argument('--poll', action='store_true',
+        help='Store the market listings of every subtype and rarity')
     parser.add_argument('--subtype', default='None',
         help='Subtype for market data')
     parser.add_argument('--rarity', default='None',
@@ -423,19 +937,39 @@ if __name__ == "__main__":
         help='Get Recipe for Item')
     parser.add_argument('--price', default=None,
         help='Get Price on Item')
+    parser.add_argument('--loadout', default=None,
+        help='Get the best items for enhancements, e.g. attack,hp=0.5')
+    parser.add_argument('--budget', default=None, type=int,
+        help='Budget in bux for --loadout')
+    parser.add_argument('--character', default=None,
+        help='Character to equip for --loadout')
+    parser.add_argument('--uses', default=None,
+        help='Get the items crafted with an item')
     parser.add_argument('--list', action='store_true',
         help='Get List of items')
+    parser.add_argument('--crafts', default=None, type=int, const=10, nargs='?',
+        help='Get the most profitable crafts')
     args = parser.parse_args()
 
     if args.market is True:
         # python3 pss_market.py --market --rarity Unique
         txt = get_market_data(subtype=args.subtype, rarity=args.rarity)
         print(txt.strip())
+    elif args.poll is True:
+        # python3 pss_market.py --poll
+        poll_market()
     elif args.list is True:
         # python3 pss_market.py --list
         txt_list = get_item_list()
         for txt in txt_list:
             print(txt)
+    elif args.crafts is not None:
+        # python3 pss_market.py --crafts 20
+        content = get_profitable_crafts(args.crafts)
+        if content is None:
+            print('No craftable items have prices')
+        else:
+            print('\n'.join(content))
     elif args.stats is not None:
         # python3 pss_market.py --stats 'assault armor'
         pass
@@ -446,6 +980,18 @@ if __name__ == "__main__":
             content = '**Recipe for {}**\n'.format(real_name) + content
             content = content + '\n\nNote: bux prices listed here may not always be accurate due to transfers between alts/friends or other reasons'
         print(content)
+    elif args.loadout is not None:
+        # python3 pss_market.py --loadout attack,hp=0.5 --budget 5000
+        txt, success = get_loadout(
+            parse_weights(args.loadout), args.budget, args.character)
+        print(txt)
+    elif args.uses is not None:
+        # python3 pss_market.py --uses 'titanium'
+        content, real_name = get_item_uses(args.uses)
+        if real_name is None:
+            print('{} not found'.format(args.uses))
+        else:
+            print('\n'.join(content))
     elif args.price is not None:
         # python3 pss_market.py --price 'assault armor'
         item_name = args.price
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Pixel Starships Market Store
+#
+# Append-only history of the marketplace messages, keyed by MessageId so
+# that a listing downloaded twice is only stored once
+
+
+# ----- Packages ------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+import argparse
+import calendar
+import datetime
+import numpy as np
+import re
+import sqlite3
+import threading
+import time
+
+import pss_core as core
+
+
+MARKET_DB_FILE = 'pss-market.sqlite'
+DAY = 24*3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS listings (
+    message_id   INTEGER PRIMARY KEY,
+    item_name    TEXT NOT NULL,
+    quantity     INTEGER NOT NULL,
+    price        REAL NOT NULL,
+    currency     TEXT NOT NULL,
+    user_name    TEXT,
+    sub_type     TEXT,
+    rarity       TEXT,
+    message_date REAL NOT NULL,
+    fetched      REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS listings_item_date
+    ON listings (item_name, message_date);
+CREATE INDEX IF NOT EXISTS listings_date
+    ON listings (message_date);
+'''
+
+
+# ----- Parsing -------------------------------------------------------
+def parse_message(message):
+    # 'Zombie Hat x2' -> ('Zombie Hat', 2)
+    m = re.match(r'(.+?)\s+x(\d+)$', message.strip())
+    if m is None:
+        return message.strip(), 1
+    return m.group(1), int(m.group(2))
+
+
+def parse_activity_argument(argument):
+    # 'starbux:500' -> (500.0, 'starbux')
+    currency, _, price = argument.partition(':')
+    try:
+        return float(price), currency
+    except ValueError:
+        return None, currency
+
+
+def parse_message_date(date_txt):
+    # '2018-07-12T10:02:37' or '2018-07-12T10:02:37.123' (UTC)
+    date_txt = date_txt.split('.')[0]
+    dt = datetime.datetime.strptime(date_txt, '%Y-%m-%dT%H:%M:%S')
+    return calendar.timegm(dt.timetuple())
+
+
+def parse_listings(mkt_data, fetched=None):
+    """Rows of the listings table from ListActiveMarketplaceMessages2.
+    Listings that cannot be parsed (no MessageId, unknown date format)
+    are skipped"""
+    if fetched is None:
+        fetched = time.time()
+    rows = []
+    for record in core.iter_xml_records(mkt_data, tag='Message'):
+        price, currency = parse_activity_argument(record.get('ActivityArgument', ''))
+        if price is None:
+            continue
+        item_name, quantity = parse_message(record.get('Message', ''))
+        try:
+            message_id = int(record['MessageId'])
+            message_date = parse_message_date(record['MessageDate'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        rows.append((
+            message_id, item_name, quantity, price, currency,
+            record.get('UserName'), record.get('SubType'), record.get('Rarity'),
+            message_date, fetched))
+    return rows
+
+
+# ----- Store ---------------------------------------------------------
+class MarketStore(object):
+    """sqlite store of the marketplace listings. The connection is shared
+    between threads, so every access goes through the lock"""
+
+    def __init__(self, filename=MARKET_DB_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+            cursor = self.conn.execute('SELECT message_id FROM listings')
+            self.seen = set(row[0] for row in cursor)
+            cursor = self.conn.execute('SELECT DISTINCT item_name FROM listings')
+            self.item_names = [row[0] for row in cursor]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def add(self, rows):
+        """Stores the listings that are not stored yet. Returns the number
+        of new listings"""
+        with self.lock:
+            rows = [row for row in rows if row[0] not in self.seen]
+            if len(rows) == 0:
+                return 0
+            # The listings only count as seen once they are committed, so
+            # a failed commit is retried with the next download
+            with self.conn:
+                before = self.conn.total_changes
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO listings VALUES (?,?,?,?,?,?,?,?,?,?)', rows)
+                n_added = self.conn.total_changes - before
+            self.seen.update(row[0] for row in rows)
+            # A new list (not an update in place) when names are added,
+            # so the name index over it is rebuilt
+            new_names = set(row[1] for row in rows).difference(self.item_names)
+            if len(new_names) > 0:
+                self.item_names = self.item_names + sorted(new_names)
+            return n_added
+
+    def ingest(self, mkt_data):
+        return self.add(parse_listings(mkt_data))
+
+    def get_unit_prices(self, item_name, days=7, currency='starbux', now=None):
+        """Price per item of the listings of item_name posted in the last
+        days, as an array"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                'SELECT price / quantity FROM listings '
+                'WHERE item_name = ? AND message_date >= ? AND currency = ?',
+                (item_name, now - days*DAY, currency))
+            prices = [row[0] for row in cursor]
+        return np.array(prices, dtype=float)
+
+    def get_price_stats(self, item_name, days=7, currency='starbux',
+                        percentiles=(25, 50, 75), now=None):
+        """{'count': n, 'median': x, 25: x, 50: x, 75: x} of the unit
+        prices of item_name over the last days (None if not listed)"""
+        prices = self.get_unit_prices(item_name, days, currency, now)
+        if len(prices) == 0:
+            return None
+        stats = {'count': len(prices), 'median': float(np.median(prices))}
+        for q, value in zip(percentiles, np.percentile(prices, percentiles)):
+            stats[q] = float(value)
+        return stats
+
+    def get_listing_counts(self, days=7, now=None, limit=None):
+        """[(item_name, number of listings)] over the last days, most
+        listed first"""
+        if now is None:
+            now = time.time()
+        query = 'SELECT item_name, COUNT(*) AS n FROM listings ' \
+            'WHERE message_date >= ? GROUP BY item_name ORDER BY n DESC, item_name'
+        args = (now - days*DAY,)
+        if limit is not None:
+            query += ' LIMIT ?'
+            args += (limit,)
+        with self.lock:
+            return self.conn.execute(query, args).fetchall()
+
+    def get_item_names(self):
+        """Names of the listed items. The list is not changed in place,
+        it is replaced when new names are stored"""
+        with self.lock:
+            return self.item_names
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MarketStore()
+        return _store
+
+
+# ----- Text ----------------------------------------------------------
+def get_price_history(item_name, days=7, currency='starbux'):
+    """Market listing prices of an item over the last days, matched
+    against the names of the stored listings. Returns (text, real_name)"""
+    store = get_store()
+    names = store.get_item_names()
+    index = core.get_name_index(names, core.fix_search_text)
+    real_name = index.find(item_name)
+    if real_name is None:
+        matches = index.search(item_name)
+        real_name = matches[0] if len(matches) > 0 else \
+            core.get_fuzzy_name(item_name, names, core.fix_search_text)
+    if real_name is None:
+        return None, None
+
+    stats = store.get_price_stats(real_name, days, currency)
+    if stats is None:
+        return '{} has not been listed in the last {} days'.format(
+            real_name, days), real_name
+    txt = '**{} market listings ({} days)**\n'.format(real_name, days)
+    txt += 'Listings: {}\n'.format(stats['count'])
+    txt += 'Median: {:,.0f} {}\n'.format(stats['median'], currency)
+    txt += '25% - 75%: {:,.0f} - {:,.0f} {}'.format(stats[25], stats[75], currency)
+    return txt, real_name
+
+
+# ----- Async ---------------------------------------------------------
+async def get_price_history_async(item_name, days=7, currency='starbux'):
+    return await core.run_in_executor(get_price_history, item_name, days, currency)
+
+
+# ----- Main ----------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+        'Pixel Starships Market Store')
+    parser.add_argument('item', nargs='?', default=None,
+        help='Item to get the listing prices of')
+    parser.add_argument('--days', default=7, type=int,
+        help='Number of days of listings')
+    args = parser.parse_args()
+
+    if args.item is None:
+        # python3 pss_market_store.py --days 30
+        for item_name, n in get_store().get_listing_counts(args.days, limit=20):
+            print('{}: {}'.format(item_name, n))
+    else:
+        # python3 pss_market_store.py 'assault armor' --days 30
+        txt, real_name = get_price_history(args.item, args.days)
+        print('{} not found'.format(args.item) if txt is None else txt)
@@ -14,59 +14,42 @@ from __future__ import unicode_literals
 import argparse
 import csv
 import re
-import os
-import pandas as pd
-import urllib.request
-import xml.etree.ElementTree
-from io import StringIO
+import pss_designs as designs
+import pss_prestige_graph as prestige_graph
 from pss_core import *
 
 
 # Discord limits messages to 2000 characters
 MESSAGE_CHARACTER_LIMIT = 2000
 
-base_url = 'http://{}/'.format(get_production_server())
-
 
 # ----- Character Sheet -----------------------------------------------
 def request_new_char_sheet():
     # Download Character Sheet from PSS Servers
-    url = base_url + 'CharacterService/ListAllCharacterDesigns?languageKey=en'
-    data = urllib.request.urlopen(url).read()
-    return data.decode()
+    url = get_api_base_url() + 'CharacterService/ListAllCharacterDesigns?languageKey=en'
+    return get_data_from_url(url)
 
 
 def save_char_sheet_raw(char_sheet):
-    with open('pss-chars-raw.txt', 'w') as f:
-        f.write(char_sheet)
+    save_raw_text(char_sheet, 'pss-chars-raw.txt')
 
 
 def load_char_sheet_raw(refresh=False):
-    if os.path.isfile('pss-chars-raw.txt') and refresh is False:
-        with open('pss-chars-raw.txt', 'r') as f:
-            raw_text = f.read()
-    else:
-        raw_text = request_new_char_sheet()
-        save_char_sheet_raw(raw_text)
-    return raw_text
+    url = get_api_base_url() + 'CharacterService/ListAllCharacterDesigns?languageKey=en'
+    refresh = 'true' if refresh is True else 'auto'
+    return load_data_from_url('pss-chars-raw.txt', url, refresh=refresh)
 
 
 def save_char_sheet(char_sheet,
                     filename='pss-chars.txt'):
     # Process Character Sheet to CSV format
-    tree = xml.etree.ElementTree.parse(StringIO(char_sheet))
-    root = tree.getroot()
     tbl = {}
     rtbl = {}
-    rarity = {}
-    for c in root.findall('ListAllCharacterDesigns'):
-        for cc in c.findall('CharacterDesigns'):
-            for ccc in cc.findall('CharacterDesign'):
-                char_id = ccc.attrib['CharacterDesignId']
-                char_dn = ccc.attrib['CharacterDesignName']
-                rarity = ccc.attrib['Rarity']
-                tbl[char_id] = char_dn
-                rtbl[char_dn] = char_id
+    for record in iter_xml_records(char_sheet, tag='CharacterDesign'):
+        char_id = record['CharacterDesignId']
+        char_dn = record['CharacterDesignName']
+        tbl[char_id] = char_dn
+        rtbl[char_dn] = char_id
 
     # Save Character Sheet to text file
     with open(filename, 'w') as f:
@@ -89,27 +72,32 @@ def load_char_sheet(filename='pss-chars.txt'):
     return tbl, rtbl
 
 
+# (character designs, tables) of the last get_char_sheet call
+_char_tables = (None, None)
+
+
 def get_char_sheet(refresh='auto'):
-    url = base_url + 'CharacterService/ListAllCharacterDesigns?languageKey=en'
+    # The tables are rebuilt only when the character designs change, so
+    # that the name index over tbl_n2i is reused between lookups
+    global _char_tables
+    url = get_api_base_url() + 'CharacterService/ListAllCharacterDesigns?languageKey=en'
     raw_file = 'pss-chars-raw.txt'
     raw_text = load_data_from_url(raw_file, url, refresh=refresh)
-    ctbl = xmltree_to_dict3(raw_text, 'CharacterDesignId')
-    tbl_i2n = create_reverse_lookup(ctbl, 'CharacterDesignId', 'CharacterDesignName')
-    tbl_n2i = create_reverse_lookup(ctbl, 'CharacterDesignName', 'CharacterDesignId')
-    rarity = create_reverse_lookup(ctbl, 'CharacterDesignName', 'Rarity')
-    return ctbl, tbl_i2n, tbl_n2i, rarity
+    chars = designs.get_characters(raw_text)
+    if _char_tables[0] is chars:
+        return _char_tables[1]
+    ctbl = chars.by_id
+    tbl_i2n = {c.id: c.name for c in chars}
+    tbl_n2i = {c.name: c.id for c in chars}
+    rarity = {c.name: c.rarity for c in chars}
+    tables = (ctbl, tbl_i2n, tbl_n2i, rarity)
+    _char_tables = (chars, tables)
+    return tables
 
 
 def charsheet_to_df(raw_text):
-    df = pd.DataFrame()
-    root = xml.etree.ElementTree.fromstring(raw_text)
-    for c in root.findall('ListAllCharacterDesigns'):
-        for cc in c.findall('CharacterDesigns'):
-            for i, ccc in enumerate(cc.findall('CharacterDesign')):
-                row = pd.DataFrame(ccc.attrib, index=[i])
-                df = df.append(row)
-    df['CharacterDesignId'] = df['CharacterDesignId'].astype(int)
-    return df
+    return xml_records_to_df(raw_text, tag='CharacterDesign',
+                             dtypes={'CharacterDesignId': int})
 
 
 # ----- Parsing -------------------------------------------------------
@@ -122,27 +110,25 @@ def fix_char(char):
 
 
 def parse_char_name(char, rtbl):
-    char_original = list(rtbl.keys())
-    char_lookup = [ fix_char(s) for s in char_original ]
-    char_fixed  = fix_char(char)
+    index = get_name_index(rtbl, fix_char)
 
     # 1. Look for an exact match
-    if char_fixed in char_lookup:
-        idx = char_lookup.index(char_fixed)
-        return char_original[idx]
+    char_name = index.find(char)
+    if char_name is not None:
+        return char_name
 
     # 2. Perform a search instead
-    m = [ re.search(char_fixed, s) is not None for s in char_lookup ]
-    if sum(m) > 0:
-        # idx = m.index(True)  # forward search for match
-        idx = len(m)-1 - m[::-1].index(True)  # reverse search
-        return char_original[idx]
+    matches = index.search(char)
+    if len(matches) > 0:
+        return matches[-1]  # reverse search
     return None
 
 
-def char2id(char, rtbl):
+def char2id(char, rtbl, fuzzy=True):
     if isinstance(char, str):
         char_name = parse_char_name(char, rtbl)
+        if char_name is None and fuzzy is True:
+            char_name = get_fuzzy_name(char, rtbl, fix_char)
         if char_name is not None:
             return rtbl[char_name], char_name
         else:
@@ -155,10 +141,10 @@ def char2id(char, rtbl):
 # ----- Prestige API --------------------------------------------------
 def get_prestige_data_from_url(char_id, action):
     if action == 'to':
-        url = base_url + 'CharacterService/PrestigeCharacterTo?characterDesignId={}'.format(char_id)
+        url = get_api_base_url() + 'CharacterService/PrestigeCharacterTo?characterDesignId={}'.format(char_id)
         attrib = 'PrestigeCharacterTo'
     elif action == 'from':
-        url = base_url + 'CharacterService/PrestigeCharacterFrom?characterDesignId={}'.format(char_id)
+        url = get_api_base_url() + 'CharacterService/PrestigeCharacterFrom?characterDesignId={}'.format(char_id)
         attrib = 'PrestigeCharacterFrom'
     else:
         print('action = "{}" is invalid'.format(action))
@@ -168,14 +154,11 @@ def get_prestige_data_from_url(char_id, action):
 
 def xmltree_to_prestige_dict(raw_text):
     ptbl = []
-    root = xml.etree.ElementTree.fromstring(raw_text)
-    for c in root:
-        for cc in c:
-            for p in cc:
-                char_id1 = p.attrib['CharacterDesignId1']
-                char_id2 = p.attrib['CharacterDesignId2']
-                char_new = p.attrib['ToCharacterDesignId']
-                ptbl.append([char_id1, char_id2, char_new])
+    for record in iter_xml_records(raw_text, depth=3):
+        char_id1 = int(record['CharacterDesignId1'])
+        char_id2 = int(record['CharacterDesignId2'])
+        char_new = int(record['ToCharacterDesignId'])
+        ptbl.append([char_id1, char_id2, char_new])
     return ptbl
 
 
@@ -201,6 +184,9 @@ def prestige_tbl_to_txt(ptbl, tbl_i2n, direction):
             line = '+ {} -> {}'.format(c2, c3)
         else:
             line = '{} + {} -> {}'.format(c1, c2, c3)
+        # Plan steps carry the number of times they are done
+        if len(row) > 3 and row[3] > 1:
+            line += ' x{}'.format(row[3])
 
         if i > 0:
             line = '\n' + line
@@ -214,13 +200,16 @@ def prestige_tbl_to_txt(ptbl, tbl_i2n, direction):
     return txt_list
 
 
-def get_prestige(char_input, direction, tbl_i2n, tbl_n2i):
-    char_id, char_fixed = char2id(char_input, tbl_n2i)
+def get_prestige(char_input, direction, tbl_i2n, tbl_n2i, fuzzy=True):
+    char_id, char_fixed = char2id(char_input, tbl_n2i, fuzzy)
     if char_id is None:
         return ["Character '{}' not found".format(char_fixed)], False
 
-    raw_text = get_prestige_data_from_url(char_id, direction)
-    ptbl = xmltree_to_prestige_dict(raw_text)
+    # Answer from the local prestige graph when it covers the query
+    ptbl = prestige_graph.get_graph().query(char_id, direction)
+    if ptbl is None:
+        raw_text = get_prestige_data_from_url(char_id, direction)
+        ptbl = xmltree_to_prestige_dict(raw_text)
     if len(ptbl) == 0:
         return ["No prestige combinations found for '{}'".format(char_fixed)], False
 
@@ -233,6 +222,50 @@ def get_prestige(char_input, direction, tbl_i2n, tbl_n2i):
     return prestige_txt, True
 
 
+# ----- Prestige Plans ------------------------------------------------
+def parse_plan_query(query):
+    # 'Alien Queen from Lolita, Captain' -> ('Alien Queen', ['Lolita', 'Captain'])
+    m = re.match(r'(.+?)\s+from\s+(.+)', query.strip(), re.IGNORECASE)
+    if m is None:
+        return None, []
+    owned = [s.strip() for s in m.group(2).split(',') if s.strip()]
+    return m.group(1).strip(), owned
+
+
+def get_prestige_plan(target_input, owned_inputs, metric='steps', k=3):
+    """Finds the best chains of prestiges that turn the owned crew into
+    the target, using the local prestige graph"""
+    ctbl, tbl_i2n, tbl_n2i, _ = get_char_sheet()
+    target_id, target_name = char2id(target_input, tbl_n2i)
+    if target_id is None:
+        return ["Character '{}' not found".format(target_name)], False
+    owned_ids = []
+    for owned_input in owned_inputs:
+        char_id, char_name = char2id(owned_input, tbl_n2i)
+        if char_id is None:
+            return ["Character '{}' not found".format(char_name)], False
+        owned_ids.append(char_id)
+
+    if target_id in owned_ids:
+        return ['You already own **{}**'.format(target_name)], True
+
+    graph = prestige_graph.get_graph()
+    if not graph.is_complete():
+        return ['The prestige graph is still being downloaded, please try again later'], False
+    rarity_by_id = {char_id: c.rarity for char_id, c in ctbl.items()}
+    plans = prestige_graph.find_prestige_plans(
+        graph, owned_ids, target_id, rarity_by_id, metric, k)
+    if len(plans) == 0:
+        return ["**{}** cannot be prestiged from the crew listed".format(target_name)], False
+
+    unit = 'prestiges' if metric == 'steps' else 'rarity points'
+    plan_txt = ['**{}** prestige plans:'.format(target_name)]
+    for i, (cost, steps) in enumerate(plans):
+        plan_txt += ['Plan {} ({} {}):'.format(i + 1, cost, unit)]
+        plan_txt += prestige_tbl_to_txt(steps, tbl_i2n, 'full')
+    return plan_txt, True
+
+
 def show_new_chars(action='prestige'):
     tbl1, rtbl1 = load_char_sheet('pss-chars.txt')
     _, tbl2, rtbl2, _ = get_char_sheet()
@@ -288,16 +321,7 @@ def convert_eqpt_mask(eqpt_mask):
 
 # ----- Stats API -----------------------------------------------------
 def stats2dict(raw_text):
-    d = {}
-    root = xml.etree.ElementTree.fromstring(raw_text)
-    for c in root:
-        for cc in c:
-            for ccc in cc:
-                if ccc.tag != 'CharacterDesign':
-                    continue
-                char_name = ccc.attrib['CharacterDesignName']
-                d[char_name] = ccc.attrib
-    return d
+    return designs.get_characters(raw_text).by_name
 
 
 def get_stats(char_name, embed=False):
@@ -310,37 +334,38 @@ def get_stats(char_name, embed=False):
 
 
 def print_stats(d, char_input):
-    char_name = parse_char_name(char_input, tbl_n2i)
+    char_name = parse_char_name(char_input, d)
     if char_name is None:
         return None
 
     stats = d[char_name]
-    special = stats['SpecialAbilityType']
+    special = stats.special_ability_type
     if special in specials_lookup.keys():
         special = specials_lookup[special]
-    eqpt_mask = convert_eqpt_mask(int(stats['EquipmentMask']))
-    coll_id   = stats['CollectionDesignId']
+    eqpt_mask = convert_eqpt_mask(stats.equipment_mask)
+    coll_id   = stats.collection_id
+    collections, _ = get_collections()
     if coll_id in collections.keys():
-        coll_name = collections[coll_id]['CollectionName']
+        coll_name = collections[coll_id].name
     else:
         coll_name = 'None'
 
-    txt = '**{}** ({})\n'.format(char_name, stats['Rarity'])
-    txt += '{}\n'.format(stats['CharacterDesignDescription'])
+    txt = '**{}** ({})\n'.format(char_name, stats.rarity)
+    txt += '{}\n'.format(stats.description)
 
     txt += 'Race: {}, Collection: {}, Gender: {}\n'.format(
-        stats['RaceType'], coll_name, stats['GenderType'])
-    txt += 'ability = {} ({})\n'.format(stats['SpecialAbilityFinalArgument'], special)
-    txt += 'hp = {}\n'.format(stats['FinalHp'])
-    txt += 'attack = {}\n'.format(stats['FinalAttack'])
-    txt += 'repair = {}\n'.format(stats['FinalRepair'])
-    txt += 'pilot = {}\n'.format(stats['FinalPilot'])
-    txt += 'science = {}\n'.format(stats['FinalScience'])
-    txt += 'weapon = {}\n'.format(stats['FinalWeapon'])
-    txt += 'engine = {}\n'.format(stats['FinalEngine'])
-    txt += 'walk/run speed = {}/{}\n'.format(stats['WalkingSpeed'], stats['RunSpeed'])
-    txt += 'fire resist = {}\n'.format(stats['FireResistance'])
-    txt += 'training capacity = {}\n'.format(stats['TrainingCapacity'])
+        stats.race_type, coll_name, stats.gender_type)
+    txt += 'ability = {} ({})\n'.format(stats.special_ability_argument, special)
+    txt += 'hp = {}\n'.format(stats.hp)
+    txt += 'attack = {}\n'.format(stats.attack)
+    txt += 'repair = {}\n'.format(stats.repair)
+    txt += 'pilot = {}\n'.format(stats.pilot)
+    txt += 'science = {}\n'.format(stats.science)
+    txt += 'weapon = {}\n'.format(stats.weapon)
+    txt += 'engine = {}\n'.format(stats.engine)
+    txt += 'walk/run speed = {}/{}\n'.format(stats.walking_speed, stats.run_speed)
+    txt += 'fire resist = {}\n'.format(stats.fire_resistance)
+    txt += 'training capacity = {}\n'.format(stats.training_capacity)
     txt += 'equipment = {}'.format(eqpt_mask)
     return txt
 
@@ -378,47 +403,46 @@ def print_stats(d, char_input):
 # ----- Collections ---------------------------------------------------
 def get_collections():
     raw_file = 'pss-collections-raw.txt'
-    url = base_url + 'CollectionService/ListAllCollectionDesigns'
+    url = get_api_base_url() + 'CollectionService/ListAllCollectionDesigns'
     raw_text = load_data_from_url(raw_file, url, refresh='auto')
-    collections = xmltree_to_dict3(raw_text, 'CollectionDesignId')
-    collection_names = create_reverse_lookup(collections, 'CollectionDesignId', 'CollectionName')
-    return collections, collection_names
+    index = designs.get_collections(raw_text)
+    collection_names = {c.id: c.name for c in index}
+    return index.by_id, collection_names
 
 
 def get_characters_in_collection(collection_id):
     raw_file = 'pss-chars-raw.txt'
-    url = base_url + 'CharacterService/ListAllCharacterDesigns?languageKey=en'
+    url = get_api_base_url() + 'CharacterService/ListAllCharacterDesigns?languageKey=en'
     raw_text = load_data_from_url(raw_file, url, refresh='auto')
-    tbl = xmltree_to_dict3(raw_text, 'CharacterDesignId')
+    chars = designs.get_characters(raw_text)
 
     chars_in_collection = []
-    for k in tbl.keys():
-        c = tbl[k]
-        if int(c['CollectionDesignId']) == int(collection_id):
-            char_name = c['CharacterDesignName']
-            chars_in_collection.append(char_name)
+    for c in chars:
+        if c.collection_id == int(collection_id):
+            chars_in_collection.append(c.name)
     return chars_in_collection
 
 
 def show_collection(search_str):
     raw_file = 'pss-collections-raw.txt'
-    url = base_url + 'CollectionService/ListAllCollectionDesigns'
+    url = get_api_base_url() + 'CollectionService/ListAllCollectionDesigns'
     raw_text = load_data_from_url(raw_file, url, refresh='auto')
-    collections = xmltree_to_dict3(raw_text, 'CollectionDesignId')
-    collection_names = create_reverse_lookup(collections, 'CollectionDesignId', 'CollectionName') #id2names
-    collection_ids = create_reverse_lookup(collections, 'CollectionName', 'CollectionDesignId') #names2id
+    collections = designs.get_collections(raw_text)
 
-    real_name = get_real_name(search_str, list(collection_ids.keys()))
-    idx = collection_ids[real_name]
-    chars_in_collection = get_characters_in_collection(idx)
+    real_name = get_real_name(search_str, collections.by_name)
+    if real_name is None:
+        real_name = get_fuzzy_name(search_str, collections.by_name)
+    if real_name is None:
+        return None
+    c = collections.by_name[real_name]
+    chars_in_collection = get_characters_in_collection(c.id)
 
-    c = collections[idx]
     txt = ''
-    txt += '**{}** ({})\n'.format(c['CollectionName'], c['CollectionType'])
-    txt += '{}\n'.format(c['CollectionDescription'])
-    txt += 'Combo Min/Max: {}...{}\n'.format(c['MinCombo'], c['MaxCombo'])
-    txt += '{}: '.format(c['EnhancementType'])
-    txt += '{} (Base), {} (Step)\n'.format(c['BaseEnhancementValue'], c['StepEnhancementValue'])
+    txt += '**{}** ({})\n'.format(c.name, c.collection_type)
+    txt += '{}\n'.format(c.description)
+    txt += 'Combo Min/Max: {}...{}\n'.format(c.min_combo, c.max_combo)
+    txt += '{}: '.format(c.enhancement_type)
+    txt += '{} (Base), {} (Step)\n'.format(c.base_enhancement_value, c.step_enhancement_value)
     txt += 'Characters: {}'.format(', '.join(chars_in_collection))
     return txt
 
@@ -452,22 +476,40 @@ def get_char_list(action):
         return txt_list
 
 
-# ----- Setup ---------------------------------------------------------
-ctbl, tbl_i2n, tbl_n2i, rarity = get_char_sheet()
-collections, collection_names = get_collections()
+# ----- Async ---------------------------------------------------------
+async def get_prestige_async(char_input, direction, tbl_i2n, tbl_n2i, fuzzy=True):
+    return await run_in_executor(
+        get_prestige, char_input, direction, tbl_i2n, tbl_n2i, fuzzy)
+
+
+async def get_prestige_plan_async(target_input, owned_inputs, metric='steps', k=3):
+    return await run_in_executor(
+        get_prestige_plan, target_input, owned_inputs, metric, k)
+
+
+async def get_stats_async(char_name, embed=False):
+    return await run_in_executor(get_stats, char_name, embed)
+
+
+async def show_collection_async(search_str):
+    return await run_in_executor(show_collection, search_str)
+
+
+async def get_char_list_async(action):
+    return await run_in_executor(get_char_list, action)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=
         'Pixel Starships Prestige & Character Sheet API')
     parser.add_argument('prestige',
-        choices=['to', 'from', 'stats', 'refresh', 'collection', 'list'],
+        choices=['to', 'from', 'plan', 'stats', 'refresh', 'collection', 'list'],
         help='Prestige direction (to/from character)')
     parser.add_argument('character', help='Character to prestige')
     args = parser.parse_args()
 
     if args.prestige == 'refresh':
-        ctbl, tbl_i2n, tbl_n2i, rarity = get_char_sheet()
+        ctbl, tbl_i2n, tbl_n2i, rarity = get_char_sheet(refresh='true')
     elif args.prestige == 'stats':
         result = get_stats(args.character, embed=False)
         print(result)
@@ -475,6 +517,12 @@ if __name__ == '__main__':
     elif args.prestige == 'collection':
         txt = show_collection(args.character)
         print(txt)
+    elif args.prestige == 'plan':
+        # python3 pss_prestige.py plan 'Alien Queen from Lolita, Captain'
+        target, owned = parse_plan_query(args.character)
+        plan_txt, success = get_prestige_plan(target, owned)
+        for txt in plan_txt:
+            print(txt)
     elif args.prestige == 'list':
         # python3 pss_prestige.py list chars
         # python3 pss_prestige.py list newchars
@@ -483,6 +531,7 @@ if __name__ == '__main__':
             print(txt)
     else:
         # python3 pss_prestige.py to 'Alien Queen'
+        ctbl, tbl_i2n, tbl_n2i, rarity = get_char_sheet()
         prestige_txt, success = get_prestige(
             args.character, args.prestige, tbl_i2n, tbl_n2i)
         if success is True:
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Pixel Starships Prestige Graph
+#
+# Local copy of every prestige combination, crawled from
+# PrestigeCharacterFrom so that prestige lookups do not need the API
+
+
+# ----- Packages ------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+from collections import Counter
+import argparse
+import concurrent.futures
+import heapq
+import json
+import os
+import threading
+import time
+
+import pss_core as core
+
+
+GRAPH_FILE = 'pss-prestige-graph.json'
+# Characters are crawled again once their entry is older than this
+GRAPH_TTL = 24*3600
+CRAWL_WORKERS = 4
+# Failed downloads of a character before a crawl gives up on it until the
+# next crawl. The graph stays incomplete until it is crawled
+CRAWL_MAX_FAILURES = 3
+# The graph is saved every this many characters during a crawl
+CRAWL_SAVE_EVERY = 50
+REFRESH_INTERVAL = 3600
+
+
+# ----- Graph ---------------------------------------------------------
+class PrestigeGraph(object):
+    """Prestige combinations (id1 + id2 -> result) indexed by ingredient
+    and by result. `crawled` holds the time each character's
+    PrestigeCharacterFrom list was downloaded; `char_ids` is the list of
+    characters the last crawl covered; `failures` counts the failed
+    downloads of each character since it was last crawled"""
+
+    def __init__(self, pairs=(), crawled=None, char_ids=(), failures=None):
+        self.lock = threading.RLock()
+        self.crawled = {} if crawled is None else crawled
+        self.char_ids = set(char_ids)
+        self.failures = {} if failures is None else failures
+        self.by_ingredient = {}
+        self.by_result = {}
+        for char_id1, char_id2, char_new in pairs:
+            self._add(char_id1, char_id2, char_new)
+
+    def _add(self, char_id1, char_id2, char_new):
+        # A + B and B + A are the same combination
+        if char_id1 > char_id2:
+            char_id1, char_id2 = char_id2, char_id1
+        pair = (char_id1, char_id2, char_new)
+        self.by_ingredient.setdefault(char_id1, set()).add(pair)
+        self.by_ingredient.setdefault(char_id2, set()).add(pair)
+        self.by_result.setdefault(char_new, set()).add(pair)
+
+    def _remove_ingredient(self, char_id):
+        for pair in self.by_ingredient.pop(char_id, set()):
+            char_id1, char_id2, char_new = pair
+            other = char_id2 if char_id1 == char_id else char_id1
+            self.by_ingredient.get(other, set()).discard(pair)
+            self.by_result.get(char_new, set()).discard(pair)
+
+    def update(self, char_id, pairs, crawl_time=None):
+        """Replaces the combinations that use char_id"""
+        with self.lock:
+            self._remove_ingredient(char_id)
+            for pair in pairs:
+                self._add(*pair)
+            self.crawled[char_id] = time.time() if crawl_time is None else crawl_time
+            self.failures.pop(char_id, None)
+
+    def add_failure(self, char_id):
+        """Counts a failed download of char_id. Returns True once it has
+        failed CRAWL_MAX_FAILURES times"""
+        with self.lock:
+            self.failures[char_id] = self.failures.get(char_id, 0) + 1
+            return self.failures[char_id] >= CRAWL_MAX_FAILURES
+
+    def get_pairs(self):
+        with self.lock:
+            pairs = set()
+            for char_pairs in self.by_result.values():
+                pairs.update(char_pairs)
+            return sorted(pairs)
+
+    def is_complete(self):
+        """True once every character was crawled"""
+        with self.lock:
+            return len(self.char_ids) > 0 and \
+                all(char_id in self.crawled for char_id in self.char_ids)
+
+    def get_stale(self, char_ids, ttl=GRAPH_TTL):
+        now = time.time()
+        with self.lock:
+            return [char_id for char_id in char_ids
+                    if now - self.crawled.get(char_id, 0) > ttl]
+
+    def query(self, char_id, direction):
+        """Returns the prestige table ([id1, id2, result] rows, as
+        xmltree_to_prestige_dict does) or None when the graph cannot
+        answer: 'from' needs char_id to be crawled, 'to' needs a
+        complete crawl"""
+        with self.lock:
+            if direction == 'from':
+                if char_id not in self.crawled:
+                    return None
+                rows = []
+                for char_id1, char_id2, char_new in self.by_ingredient.get(char_id, ()):
+                    other = char_id2 if char_id1 == char_id else char_id1
+                    rows.append([char_id, other, char_new])
+            elif direction == 'to':
+                if not self.is_complete():
+                    return None
+                rows = [list(pair) for pair in self.by_result.get(char_id, ())]
+            else:
+                return None
+        return sorted(rows)
+
+
+# ----- Storage -------------------------------------------------------
+def save_graph(graph, filename=GRAPH_FILE):
+    with graph.lock:
+        data = {
+            'char_ids': sorted(graph.char_ids),
+            'crawled': {str(k): v for k, v in graph.crawled.items()},
+            'failures': {str(k): v for k, v in graph.failures.items()},
+            'pairs': graph.get_pairs()}
+    core.save_raw_text(json.dumps(data), filename)
+
+
+def load_graph(filename=GRAPH_FILE):
+    if not os.path.isfile(filename):
+        return PrestigeGraph()
+    try:
+        with open(filename, 'r') as f:
+            data = json.load(f)
+    except ValueError:
+        print('Ignoring unreadable prestige graph {}'.format(filename))
+        return PrestigeGraph()
+    crawled = {int(k): v for k, v in data['crawled'].items()}
+    failures = {int(k): v for k, v in data.get('failures', {}).items()}
+    pairs = [tuple(pair) for pair in data['pairs']]
+    return PrestigeGraph(pairs, crawled, data['char_ids'], failures)
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_graph():
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            _graph = load_graph()
+        return _graph
+
+
+# ----- Crawl ---------------------------------------------------------
+def download_prestige_from(char_id):
+    url = core.get_api_base_url() + \
+        'CharacterService/PrestigeCharacterFrom?characterDesignId={}'.format(char_id)
+    raw_text = core.get_data_from_url_limited(url)
+    pairs = []
+    for record in core.iter_xml_records(raw_text, depth=3):
+        pairs.append((int(record['CharacterDesignId1']),
+                      int(record['CharacterDesignId2']),
+                      int(record['ToCharacterDesignId'])))
+    return pairs
+
+
+def crawl(char_ids, graph=None, ttl=GRAPH_TTL, workers=CRAWL_WORKERS, verbose=True):
+    """Downloads PrestigeCharacterFrom for the characters whose entry is
+    missing or older than ttl, at most `workers` at a time and within the
+    per-host rate limit. Failed characters are retried until they have
+    failed CRAWL_MAX_FAILURES times. The graph is saved every
+    CRAWL_SAVE_EVERY characters and at the end, so an interrupted crawl
+    keeps its progress. Returns the number of characters crawled"""
+    if graph is None:
+        graph = get_graph()
+    char_ids = list(char_ids)
+    with graph.lock:
+        graph.char_ids = set(char_ids)
+    stale = graph.get_stale(char_ids, ttl)
+    if len(stale) == 0:
+        return 0
+
+    n_crawled = 0
+    n_unsaved = 0
+    pending = stale
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            while len(pending) > 0:
+                futures = {pool.submit(download_prestige_from, char_id): char_id
+                           for char_id in pending}
+                pending = []
+                for future in concurrent.futures.as_completed(futures):
+                    char_id = futures[future]
+                    try:
+                        graph.update(char_id, future.result())
+                        n_crawled += 1
+                    except Exception as e:
+                        print('Prestige crawl of character {} failed: {}'.format(char_id, e))
+                        if graph.add_failure(char_id):
+                            print('Prestige crawl: giving up on character {} '
+                                  'until the next crawl'.format(char_id))
+                        else:
+                            pending.append(char_id)
+                    n_unsaved += 1
+                    if n_unsaved >= CRAWL_SAVE_EVERY:
+                        save_graph(graph)
+                        n_unsaved = 0
+    finally:
+        save_graph(graph)
+    if verbose is True:
+        print('Prestige graph: crawled {} of {} characters'.format(
+            n_crawled, len(stale)))
+    if not graph.is_complete():
+        with graph.lock:
+            missing = sorted(graph.char_ids.difference(graph.crawled))
+        print('Prestige graph: {} characters were never crawled ({}), '
+              'prestige lookups to a character use the API'.format(
+                  len(missing), ', '.join(str(char_id) for char_id in missing[:10])))
+    return n_crawled
+
+
+def start_background_refresh(get_char_ids, interval=REFRESH_INTERVAL):
+    """Keeps the graph fresh from a daemon thread. get_char_ids is called
+    before each pass so that new characters are picked up"""
+    def refresh():
+        while True:
+            try:
+                crawl(get_char_ids(), verbose=False)
+            except Exception as e:
+                print('Prestige graph refresh failed: {}'.format(e))
+            time.sleep(interval)
+
+    thread = threading.Thread(target=refresh, name='prestige-graph', daemon=True)
+    thread.start()
+    return thread
+
+
+# ----- Path Finder ---------------------------------------------------
+# Value of a crew member of each rarity, used by metric='rarity' to
+# prefer plans that sacrifice less valuable crew
+RARITY_COST = {
+    'Common': 1,
+    'Elite': 2,
+    'Unique': 4,
+    'Epic': 8,
+    'Hero': 16,
+    'Special': 32,
+    'Legendary': 64}
+INFINITY = float('inf')
+
+
+def get_costs(graph, owned_ids, rarity_by_id=None, metric='steps'):
+    """Cheapest cost of obtaining every reachable character from the
+    owned ones (Knuth's generalization of Dijkstra to A + B -> C rules).
+    metric='steps' counts prestiges; metric='rarity' adds up the
+    RARITY_COST of the owned crew that are used up.
+    Owned crew are assumed to be available as often as a plan needs them.
+    Returns ({char_id: cost}, {char_id: (id1, id2)})"""
+    costs = {}
+    for char_id in owned_ids:
+        if metric == 'rarity':
+            rarity = rarity_by_id.get(char_id) if rarity_by_id else None
+            costs[char_id] = RARITY_COST.get(rarity, 1)
+        else:
+            costs[char_id] = 0
+    step_cost = 1 if metric == 'steps' else 0
+    via = {}
+    done = set()
+    heap = [(cost, char_id) for char_id, cost in costs.items()]
+    heapq.heapify(heap)
+    with graph.lock:
+        while heap:
+            cost, char_id = heapq.heappop(heap)
+            if char_id in done:
+                continue
+            done.add(char_id)
+            for char_id1, char_id2, char_new in graph.by_ingredient.get(char_id, ()):
+                if char_new in done or \
+                        char_id1 not in done or char_id2 not in done:
+                    continue
+                new_cost = costs[char_id1] + costs[char_id2] + step_cost
+                if new_cost < costs.get(char_new, INFINITY):
+                    costs[char_new] = new_cost
+                    via[char_new] = (char_id1, char_id2)
+                    heapq.heappush(heap, (new_cost, char_new))
+    return costs, via
+
+
+def _get_steps(char_ids, via):
+    """(id1, id2, result, count) prestiges that make each of char_ids
+    once, in an order they can be done in. count is how many times the
+    result is needed, so that the counts add up to the cost in steps"""
+    order = []
+    seen = set()
+
+    def visit(char_id):
+        if char_id in seen or char_id not in via:
+            return
+        seen.add(char_id)
+        for ingredient_id in via[char_id]:
+            visit(ingredient_id)
+        order.append(char_id)
+
+    for char_id in char_ids:
+        visit(char_id)
+    needed = Counter(char_ids)
+    for char_id in reversed(order):
+        for ingredient_id in via[char_id]:
+            needed[ingredient_id] += needed[char_id]
+    return [via[char_id] + (char_id, needed[char_id]) for char_id in order]
+
+
+def find_prestige_plans(graph, owned_ids, target_id, rarity_by_id=None,
+                        metric='steps', k=3):
+    """Returns up to k (cost, steps) plans to obtain target_id, cheapest
+    first. steps are (id1, id2, result, count) prestiges in the order
+    they are done; the plans differ in the final prestige"""
+    owned_ids = set(owned_ids)
+    if target_id in owned_ids:
+        return [(0, [])]
+    costs, via = get_costs(graph, owned_ids, rarity_by_id, metric)
+    step_cost = 1 if metric == 'steps' else 0
+
+    with graph.lock:
+        recipes = list(graph.by_result.get(target_id, ()))
+    candidates = []
+    for char_id1, char_id2, _ in recipes:
+        cost = costs.get(char_id1, INFINITY) + costs.get(char_id2, INFINITY)
+        if cost < INFINITY:
+            candidates.append((cost + step_cost, char_id1, char_id2))
+
+    plans = []
+    for cost, char_id1, char_id2 in heapq.nsmallest(k, candidates):
+        steps = _get_steps((char_id1, char_id2), via)
+        steps.append((char_id1, char_id2, target_id, 1))
+        plans.append((cost, steps))
+    return plans
+
+
+# ----- Main ----------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+        'Pixel Starships Prestige Graph')
+    parser.add_argument('--full', action='store_true',
+        help='Crawl every character, not only stale ones')
+    args = parser.parse_args()
+
+    # python3 pss_prestige_graph.py
+    import pss_prestige as p
+    _, tbl_i2n, _, _ = p.get_char_sheet()
+    crawl(tbl_i2n.keys(), ttl=-1 if args.full else GRAPH_TTL)
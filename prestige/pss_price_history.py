@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Pixel Starships Item Price History
+#
+# MarketPrice and FairPrice of every item design per day, collected from
+# the daily item design dumps into typed arrays
+
+
+# ----- Packages ------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+import argparse
+import datetime
+import numpy as np
+import os
+import re
+
+import pss_array_history as ah
+import pss_core as core
+import pss_designs as designs
+
+
+HISTORY_FILE = 'data/item-prices.npz'
+DATA_DIR = 'data'
+# items-20180712.txt (and the items20180712.txt files older versions wrote)
+DUMP_PATTERN = re.compile(r'^items-?(\d{8})\.txt$')
+# Price of an item on a day it did not exist yet
+MISSING = -1
+COLUMNS = ('MarketPrice', 'FairPrice')
+
+
+# ----- History -------------------------------------------------------
+class PriceHistory(ah.ArrayHistory):
+    """Prices as [date, item] int32 arrays, one per column of COLUMNS,
+    with the dates (datetime64[D], sorted, as times) and ItemDesignIds
+    (sorted, as ids) along the axes"""
+
+    COLUMNS = COLUMNS
+    MISSING = MISSING
+    TIME_DTYPE = 'datetime64[D]'
+    ID_DTYPE = np.int32
+    TIME_KEY = 'dates'
+    ID_KEY = 'item_ids'
+
+    def add(self, date, item_ids, market_prices, fair_prices):
+        """Sets the prices of one day (replacing that day if present)"""
+        super(PriceHistory, self).add(
+            np.datetime64(date, 'D'), item_ids,
+            {'MarketPrice': market_prices, 'FairPrice': fair_prices},
+            replace=True)
+
+    def get_row(self, date):
+        return super(PriceHistory, self).get_row(np.datetime64(date, 'D'))
+
+    def get_price(self, item_id, date=None, column='MarketPrice'):
+        """Price of an item on the last day on or before date (the last
+        day by default), or None if it is not known"""
+        with self.lock:
+            if len(self.times) == 0:
+                return None
+            i = len(self.times) - 1 if date is None else self.get_row(date)
+            j = np.searchsorted(self.ids, item_id)
+            if i is None or j == len(self.ids) or self.ids[j] != item_id:
+                return None
+            price = int(self.values[column][i, j])
+        return None if price == MISSING else price
+
+    def get_changes(self, days=7, date=None, column='MarketPrice'):
+        """(item_ids, old prices, new prices, relative change) between the
+        last day on or before date and `days` before it, for the items
+        that have a price on both days"""
+        with self.lock:
+            if len(self.times) == 0:
+                return (np.array([], dtype=np.int32),) + \
+                    (np.array([]),)*3
+            if date is None:
+                date = self.times[-1]
+            date = np.datetime64(date, 'D')
+            i_new = self.get_row(date)
+            i_old = self.get_row(date - np.timedelta64(days, 'D'))
+            if i_new is None or i_old is None:
+                return (np.array([], dtype=np.int32),) + \
+                    (np.array([]),)*3
+            old = self.values[column][i_old].astype(float)
+            new = self.values[column][i_new].astype(float)
+            item_ids = self.ids
+        m = (old > 0) & (new > 0)
+        old, new, item_ids = old[m], new[m], item_ids[m]
+        return item_ids, old, new, new/old - 1
+
+    def get_top_movers(self, days=7, k=10, date=None, column='MarketPrice'):
+        """The k items with the largest relative price change (either
+        way) as [(item_id, old, new, change)]"""
+        item_ids, old, new, change = self.get_changes(days, date, column)
+        order = np.argsort(-np.abs(change), kind='stable')[:k]
+        return [(int(item_ids[i]), int(old[i]), int(new[i]), float(change[i]))
+                for i in order]
+
+
+# ----- Storage -------------------------------------------------------
+def get_history():
+    return ah.get_history(PriceHistory, HISTORY_FILE)
+
+
+# ----- Ingestion -----------------------------------------------------
+def add_dump(history, date, raw_text):
+    # Parsed directly: the registry only holds today's designs
+    items = designs.DesignIndex.from_xml(designs.ItemDesign, raw_text)
+    history.add(date,
+                [d.id for d in items],
+                [d.market_price for d in items],
+                [d.fair_price for d in items])
+
+
+def find_dumps(data_dir=DATA_DIR):
+    """{date: filename} of the daily item design dumps"""
+    dumps = {}
+    if not os.path.isdir(data_dir):
+        return dumps
+    for filename in sorted(os.listdir(data_dir)):
+        m = DUMP_PATTERN.match(filename)
+        if m is not None:
+            date = datetime.datetime.strptime(m.group(1), '%Y%m%d').date()
+            dumps[date] = os.path.join(data_dir, filename)
+    return dumps
+
+
+def update_history(data_dir=DATA_DIR, filename=HISTORY_FILE, verbose=True):
+    """Adds the dumps of the days missing from the history, so each dump
+    is only parsed once. Returns the number of days added"""
+    history = get_history()
+    known = set(history.times.astype(object))
+    n_added = 0
+    for date, dump_file in sorted(find_dumps(data_dir).items()):
+        if date in known:
+            continue
+        add_dump(history, date, core.load_raw_text(dump_file))
+        n_added += 1
+    if n_added > 0:
+        ah.save_history(history, filename)
+    if verbose is True:
+        print('Price history: added {} days, {} days in total'.format(
+            n_added, len(history.times)))
+    return n_added
+
+
+def record_today(raw_text, filename=HISTORY_FILE):
+    """Adds (or replaces) today's prices with a freshly downloaded dump"""
+    history = get_history()
+    add_dump(history, datetime.date.today(), raw_text)
+    ah.save_history(history, filename)
+
+
+# ----- Text ----------------------------------------------------------
+def format_change(change):
+    return '{:+.1f}%'.format(100*change)
+
+
+def get_price_changes_txt(item_id, item_name, date=None):
+    history = get_history()
+    price = history.get_price(item_id, date)
+    if price is None:
+        return 'No price history for {}'.format(item_name)
+
+    txt = '**{}**: {} bux'.format(item_name, price if price > 0 else 'NA')
+    for days in (7, 30):
+        if date is None:
+            old_date = history.times[-1] - np.timedelta64(days, 'D')
+        else:
+            old_date = np.datetime64(date, 'D') - np.timedelta64(days, 'D')
+        old_price = history.get_price(item_id, old_date)
+        if old_price is not None and old_price > 0 and price > 0:
+            txt += ', {} days: {}'.format(days, format_change(price/old_price - 1))
+    return txt
+
+
+def get_top_movers_txt(item_names, days=7, k=10):
+    """item_names is {ItemDesignId: name}"""
+    movers = get_history().get_top_movers(days, k)
+    if len(movers) == 0:
+        return None
+    txt = '**Top price movers ({} days)**\n'.format(days)
+    for item_id, old, new, change in movers:
+        txt += '{}: {} -> {} bux ({})\n'.format(
+            item_names.get(item_id, item_id), old, new, format_change(change))
+    return txt.strip('\n')
+
+
+# ----- Main ----------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+        'Pixel Starships Item Price History')
+    parser.add_argument('--movers', default=None, type=int, const=7, nargs='?',
+        help='Get the items whose price changed the most over a number of days')
+    args = parser.parse_args()
+
+    # python3 pss_price_history.py --movers 30
+    update_history()
+    if args.movers is not None:
+        dumps = find_dumps()
+        raw_text = core.load_raw_text(dumps[max(dumps)])
+        items = designs.get_items(raw_text)
+        item_names = {d.id: d.name for d in items}
+        print(get_top_movers_txt(item_names, args.movers))
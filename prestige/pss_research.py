@@ -13,30 +13,16 @@ from __future__ import unicode_literals
 
 import argparse
 import datetime
-import re
 import os
-import pandas as pd
-import urllib.request
+import pss_designs as designs
 import uuid
-import xml.etree.ElementTree
 
 from pss_core import *
 
 HOME = os.getenv('HOME')
-base_url = 'http://{}/'.format(get_production_server())
 
 
 # ----- Utilities -----------------------------------------------------
-def xmltext_to_df(raw_text):
-    df = pd.DataFrame()
-    root = xml.etree.ElementTree.fromstring(raw_text)
-    for c in root:
-        for cc in c:
-            for i, ccc in enumerate(cc):
-                df = df.append(pd.DataFrame(ccc.attrib, index=[i]))
-    return df
-
-
 def seconds_to_str(sec):
     rt = datetime.timedelta(seconds=int(sec))
     if sec % (24*3600) == 0:
@@ -55,7 +41,24 @@ def convert_cost(data):
     return ', '.join(cost)
 
 
-def research_to_txt(df):
+def research_path_to_txt(research_id, tree):
+    research = tree.research.by_id
+    txt = ''
+    chain = tree.chains.get(research_id, [])
+    if len(chain) > 0:
+        txt += '\nRequires: {}\n'.format(
+            ' -> '.join(research[r].name for r in chain))
+        gas, starbux, seconds, lab_level = tree.totals[research_id]
+        txt += 'Total from scratch: {}, {} (Lab Lvl {})'.format(
+            convert_cost({'GasCost': gas, 'StarbuxCost': starbux}),
+            seconds_to_str(seconds), lab_level)
+    unlocks = tree.unlocks.get(research_id, [])
+    if len(unlocks) > 0:
+        txt += '\nUnlocks: {}'.format(', '.join(research[r].name for r in unlocks))
+    return txt
+
+
+def research_to_txt(df, tree=None):
     if len(df) == 0:
         return None
     elif len(df) == 1:
@@ -65,6 +68,8 @@ def research_to_txt(df):
         txt += 'Cost: {}\n'.format(convert_cost(data))
         txt += 'Time: {}\n'.format(seconds_to_str(data['ResearchTime']))
         txt += 'Reqd Lab Lvl: {}'.format(data['RequiredLabLevel'])
+        if tree is not None:
+            txt += research_path_to_txt(int(data['ResearchDesignId']), tree)
         return txt
 
     txt = ''
@@ -77,27 +82,30 @@ def research_to_txt(df):
 
 
 def filter_researchdf(df, search_str):
-    research_lookup = df['ResearchName'].str.lower()
-    df_subset = df[research_lookup == search_str.lower()]
-    if len(df_subset) == 1:
-        return df_subset.copy()
-    m = [re.search(search_str.lower(), str(s)) is not None for s in research_lookup ]
-    return df[m].copy()
+    index = get_name_index(df['ResearchName'], source=df)
+    research_name = index.find(search_str)
+    if research_name is not None:
+        return df[df['ResearchName'] == research_name].copy()
+    matches = index.search(search_str)
+    if len(matches) == 0:
+        # Nothing contains the search string, try misspellings
+        matches = [name for name, score in index.fuzzy(search_str)]
+    return df[df['ResearchName'].isin(matches)].copy()
+
+
+def load_research_designs():
+    raw_file = 'research-designs-raw.txt'
+    url = get_api_base_url() + 'ResearchService/ListAllResearchDesigns2?languageKey=en'
+    raw_text = load_data_from_url(raw_file, url, refresh='auto')
+    return designs.get_research(raw_text)
 
 
 def get_research_designs(format='df'):
-    raw_file = 'research-designs-raw.txt'
-    url = base_url + 'ResearchService/ListAllResearchDesigns2?languageKey=en'
-    raw_text = load_data_from_url(raw_file, url, refresh='auto')
+    research = load_research_designs()
     if format == 'df':
-        df_research_designs = xmltext_to_df(raw_text)
-        cols = ['Argument', 'GasCost', 'ImageSpriteId', 'LogoSpriteId', 'RequiredItemDesignId',
-                'RequiredLabLevel', 'RequiredResearchDesignId', 'ResearchDesignId', 'ResearchTime',
-                'StarbuxCost']
-        df_research_designs[cols] = df_research_designs[cols].astype(int)
-        return df_research_designs
+        return research.to_df()
     else:
-        return xmltree_to_dict3(raw_text, 'ResearchName')
+        return research.by_name
 
 
 def get_research_names():
@@ -106,12 +114,68 @@ def get_research_names():
     return list_to_text(research_names)
 
 
+# ----- Research Tree -------------------------------------------------
+class ResearchTree(object):
+    """Prerequisites of the research designs, precomputed once per design
+    index. chains[id] lists the researches needed before id (first
+    first), totals[id] is the (gas, starbux, seconds, lab level) needed
+    to research id from scratch and unlocks[id] lists the researches
+    that need id"""
+
+    def __init__(self, research):
+        self.research = research
+        self.unlocks = {}
+        for r in research:
+            if r.required_research_id in research.by_id:
+                self.unlocks.setdefault(r.required_research_id, []).append(r.id)
+        self.chains = {}
+        self.totals = {}
+        for r in research:
+            self._add(r.id)
+
+    def _add(self, research_id):
+        if research_id in self.chains:
+            return
+        r = self.research.by_id[research_id]
+        required_id = r.required_research_id
+        # Guard against a research that (indirectly) requires itself
+        self.chains[research_id] = []
+        self.totals[research_id] = (r.gas_cost, r.starbux_cost,
+                                    r.research_time, r.required_lab_level)
+        if required_id not in self.research.by_id:
+            return
+        self._add(required_id)
+        gas, starbux, seconds, lab_level = self.totals[required_id]
+        self.chains[research_id] = self.chains[required_id] + [required_id]
+        self.totals[research_id] = (
+            gas + r.gas_cost, starbux + r.starbux_cost,
+            seconds + r.research_time, max(lab_level, r.required_lab_level))
+
+
+_research_tree = None
+
+
+def get_research_tree():
+    # Rebuilt only when the research designs change
+    global _research_tree
+    research = load_research_designs()
+    tree = _research_tree
+    if tree is None or tree.research is not research:
+        tree = ResearchTree(research)
+        _research_tree = tree
+    return tree
+
+
 # ----- Rooms ---------------------------------------------------------
-def get_room_designs():
+def load_room_designs():
     raw_file = 'room-designs-raw.txt'
-    url = base_url + 'RoomService/ListRoomDesigns2?languageKey=en'
+    url = get_api_base_url() + 'RoomService/ListRoomDesigns2?languageKey=en'
     raw_text = load_data_from_url(raw_file, url, refresh='auto')
-    return xmltree_to_dict3(raw_text, 'RoomName')
+    return designs.get_rooms(raw_text)
+
+
+def get_room_designs():
+    return load_room_designs().by_name
 
 
 def get_room_names():
@@ -120,25 +184,171 @@ def get_room_names():
     return list_to_text(room_names)
 
 
-def room_to_txt_description(room, room_names):
-    txt = '**{}** (Category: {}, Type: {})\n'.format(
-        room['RoomName'], room['CategoryType'], room['RoomType'])
-    txt += '{}\n'.format(room['RoomDescription'])
-    cost = []
-    if room['MineralCost'] != '0':
-        cost += ['{} minerals'.format(room['MineralCost'])]
-    if room['GasCost'] != '0':
-        cost += ['{} gas'.format(room['GasCost'])]
+def parse_price_string(price_string):
+    # 'mineral:5000' -> ('mineral', 5000)
+    unit, _, price = price_string.partition(':')
+    try:
+        return unit, int(price)
+    except ValueError:
+        return unit, 0
+
+
+class RoomIndex(object):
+    """Room designs by id and by name, with their upgrade chains
+    precomputed once per design index. chains[id] lists the rooms from
+    the first level up to id, totals[id] holds the cumulative cost per
+    unit of PriceString, the construction time and the ship level
+    needed to build every level of the chain"""
+
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.by_id = rooms.by_id
+        self.by_name = rooms.by_name
+        self.chains = {}
+        self.totals = {}
+        for room in rooms:
+            self._add(room.id)
+
+    def _add(self, room_id):
+        if room_id in self.chains:
+            return
+        room = self.by_id[room_id]
+        unit, price = parse_price_string(room.price_string)
+        # Guard against a room that (indirectly) upgrades from itself
+        self.chains[room_id] = [room_id]
+        self.totals[room_id] = ({unit: price}, room.construction_time,
+                                room.min_ship_level)
+        previous_id = room.upgrade_from_id
+        if previous_id not in self.by_id:
+            return
+        self._add(previous_id)
+        costs, seconds, ship_level = self.totals[previous_id]
+        costs = dict(costs)
+        costs[unit] = costs.get(unit, 0) + price
+        self.chains[room_id] = self.chains[previous_id] + [room_id]
+        self.totals[room_id] = (costs, seconds + room.construction_time,
+                                max(ship_level, room.min_ship_level))
+
+    def get_upgrade_cost(self, from_id, to_id):
+        """(costs, seconds, ship level) of building every level after
+        from_id up to to_id (from_id=None: from scratch), or None if
+        to_id is not an upgrade of from_id"""
+        costs, seconds, ship_level = self.totals[to_id]
+        if from_id is None:
+            return costs, seconds, ship_level
+        chain = self.chains[to_id]
+        if from_id not in chain or from_id == to_id:
+            return None
+        from_costs, from_seconds, _ = self.totals[from_id]
+        costs = {unit: price - from_costs.get(unit, 0)
+                 for unit, price in costs.items()}
+        levels = chain[chain.index(from_id) + 1:]
+        ship_level = max(self.by_id[r].min_ship_level for r in levels)
+        return costs, seconds - from_seconds, ship_level
+
+
+_room_index = None
+
+
+def get_room_index():
+    # Rebuilt only when the room designs change
+    global _room_index
+    rooms = load_room_designs()
+    index = _room_index
+    if index is None or index.rooms is not rooms:
+        index = RoomIndex(rooms)
+        _room_index = index
+    return index
+
+
+def find_room(room_index, search_str):
+    index = get_name_index(room_index.by_name)
+    room_name = index.find(search_str)
+    if room_name is None:
+        matches = index.search(search_str)
+        room_name = matches[0] if len(matches) > 0 else \
+            get_fuzzy_name(search_str, room_index.by_name)
+    if room_name is None:
+        return None
+    return room_index.by_name[room_name]
+
 
-    unit, price = room['PriceString'].split(':')
+def room_costs_to_txt(costs):
+    return ', '.join('{} {}'.format(price, unit)
+                     for unit, price in sorted(costs.items()) if price != 0)
+
+
+def room_to_txt_description(room, room_index):
+    txt = '**{}** (Category: {}, Type: {})\n'.format(
+        room.name, room.category_type, room.room_type)
+    txt += '{}\n'.format(room.description)
+    unit, price = parse_price_string(room.price_string)
     txt += 'Construction time: {}, {} Cost: {}\n'.format(
-        room['ConstructionTime'], unit, price)
-    if room['UpgradeFromRoomDesignId'] != '0':
-        txt_room_requirement = ', {}'.format(room_names[room['UpgradeFromRoomDesignId']])
-    txt += 'Requires: lvl {} ship\n'.format(room['MinShipLevel'], txt_room_requirement)
+        seconds_to_str(room.construction_time), unit, price)
+
+    txt_room_requirement = ''
+    if room.upgrade_from_id in room_index.by_id:
+        txt_room_requirement = ', {}'.format(
+            room_index.by_id[room.upgrade_from_id].name)
+    txt += 'Requires: lvl {} ship{}'.format(room.min_ship_level, txt_room_requirement)
+
+    chain = room_index.chains[room.id]
+    if len(chain) > 1:
+        costs, seconds, ship_level = room_index.get_upgrade_cost(None, room.id)
+        txt += '\nTotal from {}: {}, {} (lvl {} ship)'.format(
+            room_index.by_id[chain[0]].name, room_costs_to_txt(costs),
+            seconds_to_str(seconds), ship_level)
     return txt
 
 
+def get_room_upgrade_txt(from_name, to_name):
+    room_index = get_room_index()
+    from_room = find_room(room_index, from_name)
+    to_room = find_room(room_index, to_name)
+    if from_room is None or to_room is None:
+        return None
+    cost = room_index.get_upgrade_cost(from_room.id, to_room.id)
+    if cost is None:
+        return '{} is not an upgrade of {}'.format(to_room.name, from_room.name)
+    costs, seconds, ship_level = cost
+    return '**{} -> {}**: {}, {} (lvl {} ship)'.format(
+        from_room.name, to_room.name, room_costs_to_txt(costs),
+        seconds_to_str(seconds), ship_level)
+
+
+def get_room_txt(room_name):
+    room_index = get_room_index()
+    room = find_room(room_index, room_name)
+    if room is None:
+        return None
+    return room_to_txt_description(room, room_index)
+
+
+# ----- Async ---------------------------------------------------------
+async def get_research_designs_async(format='df'):
+    return await run_in_executor(get_research_designs, format)
+
+
+async def get_research_tree_async():
+    return await run_in_executor(get_research_tree)
+
+
+async def get_research_names_async():
+    return await run_in_executor(get_research_names)
+
+
+async def get_room_txt_async(room_name):
+    return await run_in_executor(get_room_txt, room_name)
+
+
+async def get_room_upgrade_txt_async(from_name, to_name):
+    return await run_in_executor(get_room_upgrade_txt, from_name, to_name)
+
+
+async def get_room_names_async():
+    return await run_in_executor(get_room_names)
+
+
 # ----- Main ----------------------------------------------------------
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=
@@ -147,6 +357,8 @@ if __name__ == "__main__":
         help='Get Research Data')
     parser.add_argument('--rooms', default=None,
         help='Get Room Data')
+    parser.add_argument('--upgrade', default=None, nargs=2,
+        help='Get the cost of upgrading a room from one level to another')
     args = parser.parse_args()
 
     if args.research is not None:
@@ -154,13 +366,15 @@ if __name__ == "__main__":
         research_str = args.research
         df_research_designs = get_research_designs()
         df_selected = filter_researchdf(df_research_designs, research_str)
-        txt = research_to_txt(df_selected)
+        txt = research_to_txt(df_selected, get_research_tree())
         print(txt)
     if args.rooms is not None:
         # python3 pss_research.py --rooms "Hangar Lv9"
-        rooms = get_room_designs()
-        room_names = create_reverse_lookup(rooms, 'RoomDesignId', 'RoomName')
-        txt = room_to_txt_description(rooms[args.rooms], room_names)
-        print(txt)
+        txt = get_room_txt(args.rooms)
+        print('{} not found'.format(args.rooms) if txt is None else txt)
         # room_str = args.rooms
         # print(room_str)
+    if args.upgrade is not None:
+        # python3 pss_research.py --upgrade "Hangar Lv1" "Hangar Lv9"
+        txt = get_room_upgrade_txt(*args.upgrade)
+        print('Room not found' if txt is None else txt)